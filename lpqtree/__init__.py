@@ -1,4 +1,4 @@
-from .lpqtree import KDTree
+from .lpqtree import KDTree, radius_neighbors_cfunc_addr
 #import lpqtree.lpqpydist
 
-__all__ = ["KDTree", "lpqpydist"]
+__all__ = ["KDTree", "radius_neighbors_cfunc_addr", "lpqpydist"]
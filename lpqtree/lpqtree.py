@@ -1,5 +1,6 @@
 """Sklearn interface to the native nanoflann module"""
 import copyreg
+import os
 import warnings
 from typing import Optional
 
@@ -9,34 +10,178 @@ from sklearn.neighbors._base import KNeighborsMixin, NeighborsBase, RadiusNeighb
 from sklearn.utils.validation import check_is_fitted
 from scipy.sparse import csr_matrix, coo_matrix
 
-SUPPORTED_TYPES = [np.float32, np.float64]
+SUPPORTED_TYPES = [np.float16, np.float32, np.float64]
 SUPPORTED_DIM = [2, 3]
-SUPPORTED_METRIC = ["l1", "l2", "l11", "l22", "l21"]
+# hashed copies for the per-call argument check
+_SUPPORTED_TYPES = frozenset(np.dtype(t) for t in SUPPORTED_TYPES)
+_SUPPORTED_DIM = frozenset(SUPPORTED_DIM)
+SUPPORTED_METRIC = ["l1", "l2", "l11", "l22", "l21", "l2sq"]
+
+
+def _get_nb_cpu():
+    """Number of physical cores available to the process, the distance
+    kernels are compute bound and do not benefit from hyper-threading.
+    (logical cpus are used if psutil is not installed)
+    """
+    if hasattr(os, "sched_getaffinity"):
+        nb_cpu = len(os.sched_getaffinity(0))
+    else:
+        nb_cpu = os.cpu_count() or 1
+
+    try:
+        import psutil
+        nb_physical = psutil.cpu_count(logical=False)
+    except ImportError:
+        nb_physical = None
+
+    if nb_physical:
+        return max(1, min(nb_cpu, nb_physical))
+    return max(1, nb_cpu)
+
+
+def _get_l2_cache_size():
+    """Size in bytes of the L2 cache (256KB if it can not be detected)."""
+    try:
+        size = os.sysconf("SC_LEVEL2_CACHE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        size = 0
+    return size if size > 0 else 256 * 1024
+
+
+def _get_tile_size(X):
+    """Number of queries per tile of the multithreaded searches, so that
+    a tile fits in half of the L2 cache."""
+    return max(1, L2_CACHE_SIZE // (2 * X.itemsize * X.shape[1]))
+
+
+# n_jobs=-1 searches with all cores when there are at least MIN_MULTITHREADED_QUERIES
+NB_CPU = _get_nb_cpu()
+MIN_MULTITHREADED_QUERIES = 512
+
+# Multithreaded searches are split in tiles of queries fitting in the L2 cache
+L2_CACHE_SIZE = _get_l2_cache_size()
+
+# Number of neighbors per query is estimated from a sample of NNZ_SAMPLE_SIZE
+# queries, to pre-allocate the results of batches of MIN_NNZ_ESTIMATE_QUERIES
+NNZ_SAMPLE_SIZE = 16
+MIN_NNZ_ESTIMATE_QUERIES = 1024
+
+# l21 trees of at least SOA_MIN_MPTS[last_dim] points per matrix are stored as
+# [x_0, ..., x_M, y_0, ..., y_M, ...] to vectorize the distance over points,
+# smaller ones keep their fixed-size kernels (up to 8 2D or 4 3D/4D points)
+SOA_MIN_MPTS = {2: 9, 3: 5, 4: 5}
 
 
 def pickler(c):
     X = c._fit_X if hasattr(c, "_fit_X") else None
-    return unpickler, (c.n_neighbors, c.radius, c.leaf_size, c.metric, X)
+    if getattr(c, "_fit_X_raw", None) is not None:
+        X = c._fit_X_raw
+    return unpickler, (c.n_neighbors, c.radius, c.leaf_size, c.metric, X, c.thread_affinity)
 
 
-def unpickler(n_neighbors, radius, leaf_size, metric, X):
+def unpickler(n_neighbors, radius, leaf_size, metric, X, thread_affinity=False):
     # Recreate an kd-tree instance
-    tree = KDTree(n_neighbors, radius, leaf_size, metric)
+    tree = KDTree(n_neighbors, radius, leaf_size, metric, thread_affinity)
     # Unpickling of the fitted instance
     if X is not None:
         tree.fit(X)
     return tree
 
 
+def radius_neighbors_cfunc_addr(dtype=np.float32):
+    """Address of the C radius search for a single query, to call a fitted tree from numba.
+
+    C signature (num_t is float for float32 trees, double for float64 trees):
+        int64 f(void *tree_handle, const num_t *query, num_t radius,
+                int64 *out_idx, num_t *out_dist, int64 max_k)
+    It returns the number of neighbors within radius, only the first max_k are written.
+    The query must have the (flattened) dimension of the tree data, tree_handle is
+    given by `KDTree.get_cfunc_handle()`.
+
+    Example (the ctypes function can be called from numba @njit code):
+        proto = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_float,
+                                 ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int64)
+        search = proto(radius_neighbors_cfunc_addr(np.float32))
+    """
+    if np.dtype(dtype) == np.float64:
+        return nanoflann_ext.radius_single_query_addr64()
+    if np.dtype(dtype) in (np.float16, np.float32):
+        return nanoflann_ext.radius_single_query_addr32()
+    raise ValueError(f"Supported types: {dtype} not in {SUPPORTED_TYPES}")
+
+
 def _check_arg(points):
-    if points.dtype not in SUPPORTED_TYPES:
+    if points.dtype not in _SUPPORTED_TYPES:
         raise ValueError(f"Supported types: {points.dtype} not in {SUPPORTED_TYPES}")
-    if len(points.shape) not in SUPPORTED_DIM:
-        raise ValueError(f"Incorrect shape {len(points.shape)} not in {SUPPORTED_DIM}")
+    if points.ndim not in _SUPPORTED_DIM:
+        raise ValueError(f"Incorrect shape {points.ndim} not in {SUPPORTED_DIM}")
+
+
+def _as_float(points):
+    """Return float16 points cast to float32 (no half precision kd-tree)."""
+    if points.dtype == np.float16:
+        return points.astype(np.float32)
+    return points
+
+
+def _as_c2d(points):
+    """Return points as a C-contiguous 2D array, copying only if needed."""
+    if not points.flags['C_CONTIGUOUS']:
+        warnings.warn(
+            f"Non C-contiguous array (strides {points.strides}) was copied, "
+            "use np.ascontiguousarray() beforehand to avoid this copy."
+        )
+        points = np.ascontiguousarray(points)
+    if points.ndim == 2:
+        return points
+    return points.reshape((points.shape[0], -1))
+
+
+def _get_n_jobs(n_jobs, nb_queries, warn=True):
+    if n_jobs == -1:
+        return NB_CPU if nb_queries >= MIN_MULTITHREADED_QUERIES else 1
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be -1 or a positive integer, got {n_jobs}")
+    if n_jobs > NB_CPU:
+        n_jobs = NB_CPU
+    if warn and n_jobs == 1 and NB_CPU > 1 and nb_queries >= MIN_MULTITHREADED_QUERIES:
+        warnings.warn(
+            f"Searching {nb_queries} queries with n_jobs=1, "
+            "use n_jobs=-1 to search with all cores."
+        )
+    return n_jobs
+
+
+def _as_soa(points, last_dim):
+    """Return (N, M, last_dim) points as a 2D array in SoA layout (N, last_dim*M)."""
+    points = points.reshape((points.shape[0], -1, last_dim))
+    return np.ascontiguousarray(points.transpose((0, 2, 1))).reshape((points.shape[0], -1))
+
+
+def _radius_search_mt(index, X, radius, n_jobs, nnz_per_query):
+    index.tile_size = _get_tile_size(X)
+    index.radius_neighbors_idx_multithreaded(X, radius, n_jobs, nnz_per_query)
+
+
+def _radius_search_dists_mt(index, X, radius, n_jobs, nnz_per_query):
+    index.tile_size = _get_tile_size(X)
+    index.radius_neighbors_idx_dists_multithreaded(X, radius, n_jobs, nnz_per_query)
+
+
+# C++ radius search, by (return_distance, multithreaded)
+_RADIUS_SEARCH = {
+    (True, True): _radius_search_dists_mt,
+    (True, False): lambda index, X, radius, _, nnz: index.radius_neighbors_idx_dists(X, radius, nnz),
+    (False, True): _radius_search_mt,
+    (False, False): lambda index, X, radius, _, nnz: index.radius_neighbors_idx(X, radius, nnz),
+}
 
 
 class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
-    def __init__(self, n_neighbors=5, radius=1.0, leaf_size=10, metric="l2"):
+    # frequently accessed state, as slots to skip the instance __dict__ lookup
+    __slots__ = ("index", "_fit_X", "_fit_X_raw", "_fit_X_soa", "_soa_dim", "_nb_vts_in_tree", "_nb_vts_in_search")
+
+    def __init__(self, n_neighbors=5, radius=1.0, leaf_size=10, metric="l2", thread_affinity=False):
 
         metric = metric.lower()
         if metric not in SUPPORTED_METRIC:
@@ -46,19 +191,38 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
             n_neighbors=n_neighbors, radius=radius, leaf_size=leaf_size, metric=metric
         )
 
+        self.thread_affinity = thread_affinity
         self.index = None
         self._fit_X = None
+        self._fit_X_raw = None
+        self._fit_X_soa = None
+        self._soa_dim = None
         self._nb_vts_in_tree = None
         self._nb_vts_in_search = None
 
-    def fit(self, X: np.ndarray, index_path: Optional[str] = None):
+    def fit(self, X: Optional[np.ndarray] = None, index_path: Optional[str] = None,
+            mmap_path: Optional[str] = None):
         """
         Args:
             X: np.ndarray data to use
+                float16 data is indexed as float32, the original array is kept in `_fit_X_raw`.
             index_path: str Path to a previously built index. Allows you to not rebuild index.
                 NOTE: Must use the same data on which the index was built.
+                l21 trees with more than 8 2D (or 4 3D/4D) points per matrix are stored
+                in SoA layout, an index saved for them by an earlier (AoS) build does not match.
+            mmap_path: str Path to a `.npy` file (see `np.save`) memory-mapped read-only
+                and used as data instead of X. The tree reads the mapped buffer directly,
+                pages are loaded lazily on traversal (except for float16 or l21 SoA copies).
         """
+        if mmap_path is not None:
+            if X is not None:
+                raise ValueError("X and mmap_path can not be both given")
+            X = np.load(mmap_path, mmap_mode="r")
+        elif X is None:
+            raise ValueError("X or mmap_path must be given")
         _check_arg(X)
+        self._fit_X_raw = X if X.dtype == np.float16 else None
+        X = _as_float(X)
         if X.dtype == np.float32:
             self.index = nanoflann_ext.KDTree32(
                 self.n_neighbors, self.leaf_size, self.metric, self.radius
@@ -67,6 +231,7 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
             self.index = nanoflann_ext.KDTree64(
                 self.n_neighbors, self.leaf_size, self.metric, self.radius
             )
+        self.index.thread_affinity = self.thread_affinity
 
         if X.shape[1] > 64:
             warnings.warn(
@@ -74,7 +239,7 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
                 "Consider a more suitable search structure."
             )
 
-        if self.metric == "l2" or self.metric == "l1":
+        if self.metric in ("l1", "l2", "l2sq"):
             last_dim = 1
         else:
             if X.ndim == 3:
@@ -82,9 +247,18 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
             else:
                 raise ValueError(f"{self.metric} metric should be used with 3dim array")
 
-        self._fit_X = X.reshape((X.shape[0], -1))
+        index_path = index_path if index_path is not None else ""
+        if self.metric == "l21" and last_dim in SOA_MIN_MPTS and X.shape[1] >= SOA_MIN_MPTS[last_dim]:
+            self._soa_dim = last_dim
+            self._fit_X = X.reshape((X.shape[0], -1))
+            self._fit_X_soa = _as_soa(X, last_dim)
+            self.index.fit(self._fit_X_soa, index_path, last_dim, True)
+        else:
+            self._soa_dim = None
+            self._fit_X = _as_c2d(X)
+            self._fit_X_soa = None
+            self.index.fit(self._fit_X, index_path, last_dim)
         self._nb_vts_in_tree = self._fit_X.shape[0]
-        self.index.fit(self._fit_X, index_path if index_path is not None else "", last_dim)
 
     def get_data(self, copy: bool = True) -> np.ndarray:
         """Returns underlying data points. If copy is `False` then no modifications should be applied to the returned data.
@@ -99,42 +273,59 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
         else:
             return self._fit_X
 
+    def get_cfunc_handle(self) -> int:
+        """Tree handle for `radius_neighbors_cfunc_addr()`, valid until the next fit."""
+        check_is_fitted(self, ["_fit_X"], all_or_any=any)
+        if self._soa_dim:
+            raise ValueError("The C radius search does not support SoA (l21) trees")
+        return self.index.get_handle()
+
     def save_index(self, path: str) -> int:
         """Save index to the binary file. NOTE: Data points are NOT stored."""
         return self.index.save_index(path)
 
-    def radius_neighbors(self, X, radius=None, return_distance=True, n_jobs=1, no_return=False):
+    def _estimate_nnz_per_query(self, X, radius):
+        """Estimate the number of neighbors per query from a few evenly spaced queries."""
+        if X.shape[0] < MIN_NNZ_ESTIMATE_QUERIES:
+            return 0
+        step = X.shape[0] // NNZ_SAMPLE_SIZE
+        sample = np.ascontiguousarray(X[::step][:NNZ_SAMPLE_SIZE])
+        self.index.radius_neighbors_idx(sample, radius)
+        return int(np.ceil(1.25 * np.mean(self.index.getResultLenghts())))
+
+    def radius_neighbors(self, X, radius=None, return_distance=True, n_jobs=-1, no_return=False,
+                         estimated_nnz_per_query=None):
         check_is_fitted(self, ["_fit_X"], all_or_any=any)
-        _check_arg(X)
-
-        if X.ndim == 3:
-            X = X.reshape((X.shape[0], -1))
+        if X is not self._fit_X:
+            # the fitted data was already validated in fit()
+            _check_arg(X)
+            X = _as_float(X)
+        X = _as_soa(X, self._soa_dim) if self._soa_dim else _as_c2d(X)
 
         if radius is None:
             radius = self.radius
 
-        if n_jobs == 1:
-            if return_distance:
-                self.index.radius_neighbors_idx_dists(X, radius)
-            else:
-                self.index.radius_neighbors_idx(X, radius)
-        else:
-            if return_distance:
-                self.index.radius_neighbors_idx_dists_multithreaded(X, radius, n_jobs)
-            else:
-                self.index.radius_neighbors_idx_multithreaded(X, radius, n_jobs)
+        n_jobs = _get_n_jobs(n_jobs, X.shape[0])
+        if estimated_nnz_per_query is None:
+            # only the multithreaded searches pre-allocate their results
+            estimated_nnz_per_query = self._estimate_nnz_per_query(X, radius) if n_jobs > 1 else 0
+        search = _RADIUS_SEARCH[bool(return_distance), n_jobs > 1]
+        search(self.index, X, radius, n_jobs, estimated_nnz_per_query)
 
         self._nb_vts_in_search = X.shape[0]
 
         if no_return:
             return
 
+        index = self.index
         if return_distance:
-            return self.index.getResultIndicesRow(), self.index.getResultIndicesCol(), self.index.getResultDists()
+            dists, rows, cols, _ = index.getResultArrays(with_ptr=False)
+            return rows, cols, dists
 
-        return self.index.getResultIndicesRow(), self.index.getResultIndicesCol()
+        return index.getResultIndicesRow(), index.getResultIndicesCol()
 
     # Results getter with sparse matrices
+    # (arrays sharing the buffers of the last search, no copy)
     def get_dists(self):
         return self.index.getResultDists()
 
@@ -145,48 +336,64 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
         return self.index.getResultIndicesCol()
 
     def get_csr_matrix(self):
-        mtx_shape = None
-        if self._nb_vts_in_tree and self._nb_vts_in_search:
-            mtx_shape = (self._nb_vts_in_tree, self._nb_vts_in_search)
-        return csr_matrix((self.get_dists(), self.get_cols(), self.index.getResultIndicesPtr()), shape=mtx_shape)
+        # Assembled directly from the search results (already np.intp),
+        # skips the scipy constructor validation and index dtype conversion.
+        # take=True gives the matrix its own writable buffers.
+        dists, _, cols, ptr = self.index.getResultArrays(with_rows=False, take=True)
+        mtx = csr_matrix((self._nb_vts_in_search, self._nb_vts_in_tree), dtype=dists.dtype)
+        mtx.data = dists
+        mtx.indices = cols
+        mtx.indptr = ptr
+        mtx.has_sorted_indices = False
+        return mtx
 
     def get_coo_matrix(self):
-        mtx_shape = None
-        if self._nb_vts_in_tree and self._nb_vts_in_search:
-            mtx_shape = (self._nb_vts_in_tree, self._nb_vts_in_search)
-        return coo_matrix((self.get_dists(), (self.get_rows(), self.get_cols())), shape=mtx_shape)
+        dists, rows, cols, _ = self.index.getResultArrays(with_ptr=False, take=True)
+        mtx = coo_matrix((self._nb_vts_in_search, self._nb_vts_in_tree), dtype=dists.dtype)
+        mtx.data = dists
+        mtx.row = rows
+        mtx.col = cols
+        mtx.has_canonical_format = False
+        return mtx
 
     def get_csc_matrix(self):
-        return self.get_coo_matrix().to_csc()
+        return self.get_coo_matrix().tocsc()
 
     # Advanced operation, using mean-points and full-points array
-    def radius_neighbors_full(self, X_mpts, Data_full, X_full, radius, n_jobs=1):
-        if X_mpts.ndim == 3:
-            X_mpts = X_mpts.reshape((X_mpts.shape[0], -1))
-        if Data_full.ndim == 3:
-            Data_full = Data_full.reshape((Data_full.shape[0], -1))
-        if X_full.ndim == 3:
-            X_full = X_full.reshape((X_full.shape[0], -1))
+    def radius_neighbors_full(self, X_mpts, Data_full, X_full, radius, n_jobs=-1):
+        X_mpts = _as_float(X_mpts)
+        X_mpts = _as_soa(X_mpts, self._soa_dim) if self._soa_dim else _as_c2d(X_mpts)
+        Data_full = _as_c2d(_as_float(Data_full))
+        X_full = _as_c2d(_as_float(X_full))
 
         nb_mpts = X_mpts.shape[1]
         nb_dim = X_full.shape[1]
 
-        assert(X_mpts.shape[1] <= X_full.shape[1])
+        assert X_mpts.shape[1] <= X_full.shape[1]
 
-        assert(X_full.shape[1] == Data_full.shape[1])
-        assert(X_mpts.shape[0] == X_full.shape[0])
-        assert(self.get_data(copy=False).shape[0] == Data_full.shape[0])
-        assert(nb_dim % nb_mpts == 0)
+        if X_full.shape[1] != Data_full.shape[1]:
+            raise ValueError(f"X_full and Data_full dimensions differ: {X_full.shape[1]} != {Data_full.shape[1]}")
+        if X_mpts.shape[0] != X_full.shape[0]:
+            raise ValueError(f"X_mpts and X_full sizes differ: {X_mpts.shape[0]} != {X_full.shape[0]}")
+        if self.get_data(copy=False).shape[0] != Data_full.shape[0]:
+            raise ValueError(f"Data_full size {Data_full.shape[0]} differs from the tree data size")
+        if nb_dim % nb_mpts != 0:
+            raise ValueError(f"X_mpts dimension {nb_mpts} must be a divisor of X_full dimension {nb_dim}")
 
         mpts_radius = radius * nb_mpts / nb_dim
 
+        n_jobs = _get_n_jobs(n_jobs, X_mpts.shape[0])
         if n_jobs == 1:
             self.index.radius_neighbors_idx_dists_full(X_mpts, Data_full, X_full, mpts_radius, radius)
         else:
+            self.index.tile_size = _get_tile_size(X_full)
             self.index.radius_neighbors_idx_dists_full_multithreaded(X_mpts, Data_full, X_full, mpts_radius, radius, n_jobs)
 
-    def fit_and_radius_search(self, tree_vts, search_vts, radius, n_jobs=1, nb_mpts=None):
-        assert(np.alltrue(tree_vts.shape[1:] == search_vts.shape[1:]))
+        self._nb_vts_in_search = X_mpts.shape[0]
+
+    def fit_and_radius_search(self, tree_vts, search_vts, radius, n_jobs=-1, nb_mpts=None):
+        if tree_vts.shape[1:] != search_vts.shape[1:]:
+            raise ValueError(f"tree_vts and search_vts shapes differ: {tree_vts.shape[1:]} != {search_vts.shape[1:]}")
 
         if nb_mpts:
             if not(self.metric in ["l1", "l2", "l11", "l21"]):
@@ -195,12 +402,21 @@ class KDTree(NeighborsBase, KNeighborsMixin, RadiusNeighborsMixin):
             if tree_vts.shape[1] % nb_mpts != 0:
                 raise ValueError(f"nb_mpts must be a divisor of tree_vts.shape[2]")
 
-            nb_averaged = tree_vts.shape[1] // nb_mpts
-            tree_mpts = np.mean(tree_vts.reshape((tree_vts.shape[0], nb_mpts, nb_averaged, -1)), axis=2)
-            search_mpts = np.mean(search_vts.reshape((search_vts.shape[0], nb_mpts, nb_averaged, -1)), axis=2)
+            _check_arg(tree_vts)
+            _check_arg(search_vts)
+            last_dim = tree_vts.shape[2] if tree_vts.ndim == 3 else 1
+            # contiguous 2D copies (if needed) made once, for both mean-points and full search
+            tree_full = _as_c2d(_as_float(tree_vts))
+            search_full = _as_c2d(_as_float(search_vts))
+            # the search below warns about n_jobs=1 already
+            mean_n_jobs = _get_n_jobs(n_jobs, tree_full.shape[0], warn=False)
+            tree_mpts = nanoflann_ext.mean_mpts(tree_full, nb_mpts, last_dim, mean_n_jobs)
+            tree_mpts = tree_mpts.reshape((tree_full.shape[0], nb_mpts, last_dim))
+            search_mpts = nanoflann_ext.mean_mpts(search_full, nb_mpts, last_dim, mean_n_jobs)
+            search_mpts = search_mpts.reshape((search_full.shape[0], nb_mpts, last_dim))
 
             self.fit(tree_mpts)
-            self.radius_neighbors_full(search_mpts, tree_vts, search_vts, radius, n_jobs=n_jobs)
+            self.radius_neighbors_full(search_mpts, tree_full, search_full, radius, n_jobs=n_jobs)
 
         else:
             self.fit(tree_vts)
@@ -47,21 +47,10 @@ struct L1_ND {
 
   inline DistanceType eval_pair(const T *a, const T *b, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
-    const T *lastgroup = last - 3;
-    /* Process 4 items with each loop for efficiency. */
-    while (a < lastgroup) {
-      const DistanceType diff0 = std::abs(a[0] - b[0]);
-      const DistanceType diff1 = std::abs(a[1] - b[1]);
-      const DistanceType diff2 = std::abs(a[2] - b[2]);
-      const DistanceType diff3 = std::abs(a[3] - b[3]);
-      result += diff0 + diff1 + diff2 + diff3;
-      a += 4;
-      b += 4;
-    }
-    /* Process last 0-3 components.  Not needed for standard vector lengths. */
-    while (a < last) {
-      result += std::abs(*a++ - *b++);
+
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < size; ++i) {
+      result += std::abs(a[i] - b[i]);
     }
     return result;
   }
@@ -106,22 +95,11 @@ struct L1_ND_Adaptor : L1_ND<T, DataSource, _DistanceType> {
 
   inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
-    const T *lastgroup = last - 3;
-    size_t d = 0;
+    const T *b = data_source.kdtree_get_row(b_idx);
 
-    /* Process 4 items with each loop for efficiency. */
-    while (a < lastgroup) {
-      const DistanceType diff0 = std::abs(a[0] - data_source.kdtree_get_pt(b_idx, d++));
-      const DistanceType diff1 = std::abs(a[1] - data_source.kdtree_get_pt(b_idx, d++));
-      const DistanceType diff2 = std::abs(a[2] - data_source.kdtree_get_pt(b_idx, d++));
-      const DistanceType diff3 = std::abs(a[3] - data_source.kdtree_get_pt(b_idx, d++));
-      result += diff0 + diff1 + diff2 + diff3;
-      a += 4;
-    }
-    /* Process last 0-3 components.  Not needed for standard vector lengths. */
-    while (a < last) {
-      result += std::abs(*a++ - data_source.kdtree_get_pt(b_idx, d++));
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < size; ++i) {
+      result += std::abs(a[i] - b[i]);
     }
     return result;
   }
@@ -337,4 +315,32 @@ struct L1_8D_Adaptor : L1_ND<T, DataSource, _DistanceType> {
 };
 
 
+// Fixed D, loops fully unrolled by the compiler
+template <class T, class DataSource, int D, typename _DistanceType = T>
+struct L1_Fixed_Adaptor : L1_ND<T, DataSource, _DistanceType> {
+  typedef T ElementType;
+  typedef _DistanceType DistanceType;
+
+  const DataSource &data_source;
+
+  L1_Fixed_Adaptor(const DataSource &_data_source) : data_source(_data_source) {}
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size, DistanceType worst_dist) const {
+    return evalMetric(a, b_idx, size);
+  }
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
+    DistanceType result = DistanceType();
+    const T *b = data_source.kdtree_get_row(b_idx);
+
+#pragma omp simd reduction(+:result)
+    for (int i = 0; i < D; ++i) {
+      result += std::abs(a[i] - b[i]);
+    }
+    return result;
+  }
+
+};
+
+
 #endif /* LPQ_L1_ND_CPP_ */
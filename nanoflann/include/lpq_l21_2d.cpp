@@ -42,14 +42,13 @@ struct L21_M_2D {
 
   inline DistanceType eval_pair(const T *a, const T *b, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
+    const size_t nb_pts = size / 2;
 
-    while (a < last) {
-      const DistanceType diff0 = a[0] - b[0];
-      const DistanceType diff1 = a[1] - b[1];
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < nb_pts; ++i) {
+      const DistanceType diff0 = a[2*i] - b[2*i];
+      const DistanceType diff1 = a[2*i + 1] - b[2*i + 1];
       result += std::sqrt(diff0*diff0 + diff1*diff1);
-      a += 2;
-      b += 2;
     }
     return result;
   }
@@ -86,18 +85,48 @@ struct L21_M_2D_Adaptor : L21_M_2D<T, DataSource, _DistanceType> {
 
   inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
-    size_t d = 0;
+    const T *b = data_source.kdtree_get_row(b_idx);
+    const size_t nb_pts = size / 2;
 
-    // if (size%3 != 0)
-    //   throw std::runtime_error("Error: 'dimensionality' must be a multiple of 3");
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < nb_pts; ++i) {
+      const DistanceType diff0 = a[2*i] - b[2*i];
+      const DistanceType diff1 = a[2*i + 1] - b[2*i + 1];
+      result += std::sqrt(diff0*diff0 + diff1*diff1);
+    }
+    return result;
+  }
+};
 
-    /* Process 3 items with each loop for efficiency. */
-    while (a < last) {
-      const DistanceType diff0 = a[0] - data_source.kdtree_get_pt(b_idx, d++);
-      const DistanceType diff1 = a[1] - data_source.kdtree_get_pt(b_idx, d++);
+//General, SoA layout: [x_0, ..., x_M, y_0, ..., y_M, ...]
+template <class T, class DataSource, typename _DistanceType = T>
+struct L21_M_2D_SoA_Adaptor : L21_M_2D<T, DataSource, _DistanceType> {
+  typedef T ElementType;
+  typedef _DistanceType DistanceType;
+
+  int dist_exponent = 1;
+  const DataSource &data_source;
+
+  L21_M_2D_SoA_Adaptor(const DataSource &_data_source) : data_source(_data_source) {}
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size, DistanceType worst_dist) const {
+    return evalMetric(a, b_idx, size);
+  }
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
+    DistanceType result = DistanceType();
+    const T *b = data_source.kdtree_get_row(b_idx);
+    const size_t m = size / 2;
+    const T *a0 = a;
+    const T *a1 = a + 1*m;
+    const T *b0 = b;
+    const T *b1 = b + 1*m;
+
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < m; ++i) {
+      const DistanceType diff0 = a0[i] - b0[i];
+      const DistanceType diff1 = a1[i] - b1[i];
       result += std::sqrt(diff0*diff0 + diff1*diff1);
-      a += 2;
     }
     return result;
   }
@@ -43,15 +43,14 @@ struct L21_M_3D {
 
   inline DistanceType eval_pair(const T *a, const T *b, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
+    const size_t nb_pts = size / 3;
 
-    while (a < last) {
-      const DistanceType diff0 = a[0] - b[0];
-      const DistanceType diff1 = a[1] - b[1];
-      const DistanceType diff2 = a[2] - b[2];
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < nb_pts; ++i) {
+      const DistanceType diff0 = a[3*i] - b[3*i];
+      const DistanceType diff1 = a[3*i + 1] - b[3*i + 1];
+      const DistanceType diff2 = a[3*i + 2] - b[3*i + 2];
       result += std::sqrt(diff0*diff0 + diff1*diff1 + diff2*diff2);
-      a += 3;
-      b += 3;
     }
     return result;
   }
@@ -89,15 +88,15 @@ struct L21_M_3D_Adaptor : L21_M_3D<T, DataSource, _DistanceType> {
 
   inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
-    size_t d = 0;
-
-    while (a < last) {
-      const DistanceType diff0 = a[0] - data_source.kdtree_get_pt(b_idx, d++);
-      const DistanceType diff1 = a[1] - data_source.kdtree_get_pt(b_idx, d++);
-      const DistanceType diff2 = a[2] - data_source.kdtree_get_pt(b_idx, d++);
+    const T *b = data_source.kdtree_get_row(b_idx);
+    const size_t nb_pts = size / 3;
+
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < nb_pts; ++i) {
+      const DistanceType diff0 = a[3*i] - b[3*i];
+      const DistanceType diff1 = a[3*i + 1] - b[3*i + 1];
+      const DistanceType diff2 = a[3*i + 2] - b[3*i + 2];
       result += std::sqrt(diff0*diff0 + diff1*diff1 + diff2*diff2);
-      a += 3;
     }
     return result;
   }
@@ -105,6 +104,43 @@ struct L21_M_3D_Adaptor : L21_M_3D<T, DataSource, _DistanceType> {
 };
 
 
+//General, SoA layout: [x_0, ..., x_M, y_0, ..., y_M, ...]
+template <class T, class DataSource, typename _DistanceType = T>
+struct L21_M_3D_SoA_Adaptor : L21_M_3D<T, DataSource, _DistanceType> {
+  typedef T ElementType;
+  typedef _DistanceType DistanceType;
+
+  int dist_exponent = 1;
+  const DataSource &data_source;
+
+  L21_M_3D_SoA_Adaptor(const DataSource &_data_source) : data_source(_data_source) {}
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size, DistanceType worst_dist) const {
+    return evalMetric(a, b_idx, size);
+  }
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
+    DistanceType result = DistanceType();
+    const T *b = data_source.kdtree_get_row(b_idx);
+    const size_t m = size / 3;
+    const T *a0 = a;
+    const T *a1 = a + 1*m;
+    const T *a2 = a + 2*m;
+    const T *b0 = b;
+    const T *b1 = b + 1*m;
+    const T *b2 = b + 2*m;
+
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < m; ++i) {
+      const DistanceType diff0 = a0[i] - b0[i];
+      const DistanceType diff1 = a1[i] - b1[i];
+      const DistanceType diff2 = a2[i] - b2[i];
+      result += std::sqrt(diff0*diff0 + diff1*diff1 + diff2*diff2);
+    }
+    return result;
+  }
+};
+
 //1x3D
 template <class T, class DataSource, typename _DistanceType = T>
 struct L21_1_3D_Adaptor : L21_M_3D<T, DataSource, _DistanceType> {
@@ -49,23 +49,11 @@ struct L2_ND {
 
   inline DistanceType eval_pair(const T *a, const T *b, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
-    const T *lastgroup = last - 3;
 
-    /* Process 4 items with each loop for efficiency. */
-    while (a < lastgroup) {
-      const DistanceType diff0 = a[0] - b[0];
-      const DistanceType diff1 = a[1] - b[1];
-      const DistanceType diff2 = a[2] - b[2];
-      const DistanceType diff3 = a[3] - b[3];
-      result += diff0 * diff0 + diff1 * diff1 + diff2 * diff2 + diff3 * diff3;
-      a += 4;
-      b += 4;
-    }
-    /* Process last 0-3 components.  Not needed for standard vector lengths. */
-    while (a < last) {
-      const DistanceType diff0 = *a++ - *b++;
-      result += diff0 * diff0;
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < size; ++i) {
+      const DistanceType diff = a[i] - b[i];
+      result += diff * diff;
     }
     return result;
   }
@@ -111,23 +99,12 @@ struct L2_ND_Adaptor : L2_ND<T, DataSource, _DistanceType> {
 
   inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
     DistanceType result = DistanceType();
-    const T *last = a + size;
-    const T *lastgroup = last - 3;
-    size_t d = 0;
+    const T *b = data_source.kdtree_get_row(b_idx);
 
-    /* Process 4 items with each loop for efficiency. */
-    while (a < lastgroup) {
-      const DistanceType diff0 = a[0] - data_source.kdtree_get_pt(b_idx, d++);
-      const DistanceType diff1 = a[1] - data_source.kdtree_get_pt(b_idx, d++);
-      const DistanceType diff2 = a[2] - data_source.kdtree_get_pt(b_idx, d++);
-      const DistanceType diff3 = a[3] - data_source.kdtree_get_pt(b_idx, d++);
-      result += diff0 * diff0 + diff1 * diff1 + diff2 * diff2 + diff3 * diff3;
-      a += 4;
-    }
-    /* Process last 0-3 components.  Not needed for standard vector lengths. */
-    while (a < last) {
-      const DistanceType diff0 = *a++ - data_source.kdtree_get_pt(b_idx, d++);
-      result += diff0 * diff0;
+#pragma omp simd reduction(+:result)
+    for (size_t i = 0; i < size; ++i) {
+      const DistanceType diff = a[i] - b[i];
+      result += diff * diff;
     }
     return result;
   }
@@ -384,8 +361,40 @@ struct L2_Simple_Adaptor : L2_ND<T, DataSource, _DistanceType> {
 
   inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
     DistanceType result = DistanceType();
+    const T *b = data_source.kdtree_get_row(b_idx);
+
+#pragma omp simd reduction(+:result)
     for (size_t i = 0; i < size; ++i) {
-      const DistanceType diff = a[i] - data_source.kdtree_get_pt(b_idx, i);
+      const DistanceType diff = a[i] - b[i];
+      result += diff * diff;
+    }
+    return result;
+  }
+
+};
+
+
+// Fixed D, loops fully unrolled by the compiler
+template <class T, class DataSource, int D, typename _DistanceType = T>
+struct L2_Fixed_Adaptor : L2_ND<T, DataSource, _DistanceType> {
+  typedef T ElementType;
+  typedef _DistanceType DistanceType;
+
+  const DataSource &data_source;
+
+  L2_Fixed_Adaptor(const DataSource &_data_source) : data_source(_data_source) {}
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size, DistanceType worst_dist) const {
+    return evalMetric(a, b_idx, size);
+  }
+
+  inline DistanceType evalMetric(const T *a, const size_t b_idx, size_t size) const {
+    DistanceType result = DistanceType();
+    const T *b = data_source.kdtree_get_row(b_idx);
+
+#pragma omp simd reduction(+:result)
+    for (int i = 0; i < D; ++i) {
+      const DistanceType diff = a[i] - b[i];
       result += diff * diff;
     }
     return result;
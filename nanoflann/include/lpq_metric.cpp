@@ -71,6 +71,13 @@ struct metric_L1_8D : public Metric {
   };
 };
 
+template <int D>
+struct metric_L1_Fixed : public Metric {
+  template <class T, class DataSource> struct traits {
+    typedef L1_Fixed_Adaptor<T, DataSource, D> distance_t;
+  };
+};
+
 
 /** Metaprogramming helper traits class for the L2 (Euclidean) metric */
 struct metric_L2_ND : public Metric {
@@ -127,6 +134,13 @@ struct metric_L2_8D : public Metric {
   };
 };
 
+template <int D>
+struct metric_L2_Fixed : public Metric {
+  template <class T, class DataSource> struct traits {
+    typedef L2_Fixed_Adaptor<T, DataSource, D> distance_t;
+  };
+};
+
 struct metric_L2_Simple : public Metric {
   template <class T, class DataSource> struct traits {
     typedef L2_Simple_Adaptor<T, DataSource> distance_t;
@@ -154,6 +168,12 @@ struct metric_L21_M_2D : public Metric {
   };
 };
 
+struct metric_L21_M_2D_SoA : public Metric {
+  template <class T, class DataSource> struct traits {
+    typedef L21_M_2D_SoA_Adaptor<T, DataSource> distance_t;
+  };
+};
+
 struct metric_L21_1_2D : public Metric {
   template <class T, class DataSource> struct traits {
     typedef L21_1_2D_Adaptor<T, DataSource> distance_t;
@@ -209,6 +229,12 @@ struct metric_L21_M_3D : public Metric {
   };
 };
 
+struct metric_L21_M_3D_SoA : public Metric {
+  template <class T, class DataSource> struct traits {
+    typedef L21_M_3D_SoA_Adaptor<T, DataSource> distance_t;
+  };
+};
+
 struct metric_L21_1_3D : public Metric {
   template <class T, class DataSource> struct traits {
     typedef L21_1_3D_Adaptor<T, DataSource> distance_t;
@@ -241,6 +267,12 @@ struct metric_L21_M_4D : public Metric {
   };
 };
 
+struct metric_L21_M_4D_SoA : public Metric {
+  template <class T, class DataSource> struct traits {
+    typedef L21_M_4D_SoA_Adaptor<T, DataSource> distance_t;
+  };
+};
+
 struct metric_L21_1_4D : public Metric {
   template <class T, class DataSource> struct traits {
     typedef L21_1_4D_Adaptor<T, DataSource> distance_t;
@@ -3,6 +3,7 @@ from setuptools.command.build_ext import build_ext
 import sys
 import setuptools
 import subprocess
+import os
 
 __version__ = '0.0.2'
 
@@ -78,6 +79,37 @@ def cpp_flag(compiler):
                        'is needed!')
 
 
+# SIMD instruction sets, selected with the LPQTREE_ARCH environment variable.
+# 'native' tunes for the building machine and must not be used for wheels.
+ARCH_FLAGS = {
+    'unix': {
+        'native': ['-march=native'],
+        'avx2': ['-mavx2', '-mfma'],
+        'avx512': ['-mavx2', '-mfma', '-mavx512f', '-mavx512dq'],
+    },
+    'msvc': {
+        'native': ['/arch:AVX2'],
+        'avx2': ['/arch:AVX2'],
+        'avx512': ['/arch:AVX512'],
+    },
+}
+
+
+def arch_flags(compiler):
+    """Return the supported SIMD flags for the LPQTREE_ARCH target
+    (default: avx2).
+    """
+    arch = os.environ.get('LPQTREE_ARCH', 'avx2').lower()
+    flags = ARCH_FLAGS.get(compiler.compiler_type, {})
+    if flags and arch not in flags:
+        raise RuntimeError('Unsupported LPQTREE_ARCH=%s, use one of %s'
+                           % (arch, sorted(flags)))
+
+    if compiler.compiler_type == 'msvc':
+        return flags[arch]
+    return [f for f in flags.get(arch, []) if has_flag(compiler, f)]
+
+
 class BuildExt(build_ext):
     """A custom build extension for adding compiler-specific options."""
     c_opts = {
@@ -98,20 +130,23 @@ class BuildExt(build_ext):
         ct = self.compiler.compiler_type
         opts = self.c_opts.get(ct, [])
         link_opts = self.l_opts.get(ct, [])
-        opts.append("-ffast-math")
-        opts.append("-msse2")
-        opts.append("-mfpmath=sse")
-        opts.append("-march=native")
         if ct == 'unix':
             if '-Wstrict-prototypes' in self.compiler.compiler_so:
                 self.compiler.compiler_so.remove('-Wstrict-prototypes')
 
+            # Distance kernels are vectorized through `omp simd` pragmas,
+            # no OpenMP runtime is linked and IEEE semantics are kept.
+            for flag in ["-fopenmp-simd", "-fno-math-errno", "-msse2", "-mfpmath=sse"]:
+                if has_flag(self.compiler, flag):
+                    opts.append(flag)
+
             opts.append('-DVERSION_INFO="%s"' % self.distribution.get_version())
             opts.append(cpp_flag(self.compiler))
             if has_flag(self.compiler, '-fvisibility=hidden'):
                 opts.append('-fvisibility=hidden')
         elif ct == 'msvc':
             opts.append('/DVERSION_INFO=\\"%s\\"' % self.distribution.get_version())
+        opts.extend(arch_flags(self.compiler))
         for ext in self.extensions:
             ext.extra_compile_args = opts
             ext.extra_link_args = link_opts
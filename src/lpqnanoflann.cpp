@@ -7,19 +7,156 @@ setup_pybind11(cfg)
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 
+#include <cstdint>
 #include <cstdlib>
 #include <ctime>
 #include <iostream>
+#include <memory>
+#include <numeric>
 #include <nanoflann.hpp>
 #include <lpq_metric.cpp>
+#include <atomic>
 #include <thread>
 
+#if defined(__linux__)
+#include <pthread.h>
+#include <sched.h>
+#elif defined(_WIN32)
+#define NOMINMAX
+#include <windows.h>
+#endif
+
 using namespace std;
 using namespace nanoflann;
 
 using i_np_arr_t = pybind11::array_t<size_t, pybind11::array::c_style | pybind11::array::forcecast>;
+// results indices are np.intp, the index dtype expected by scipy.sparse
+using r_idx_t = pybind11::ssize_t;
+using r_np_arr_t = pybind11::array_t<r_idx_t>;
 using vvi = std::vector<std::vector<size_t>>;
 
+// Bind the k-th worker thread to the k-th cpu available to the process
+// (no-op on unsupported platforms)
+inline void set_thread_affinity(std::thread &thread, size_t k) {
+#if defined(__linux__)
+  cpu_set_t allowed;
+  if (sched_getaffinity(0, sizeof(allowed), &allowed) != 0)
+    return;
+  const int nb_cpu = CPU_COUNT(&allowed);
+  if (nb_cpu <= 0)
+    return;
+
+  int target = k % nb_cpu;
+  for (int cpu = 0; cpu < CPU_SETSIZE; cpu++) {
+    if (CPU_ISSET(cpu, &allowed) && target-- == 0) {
+      cpu_set_t cpuset;
+      CPU_ZERO(&cpuset);
+      CPU_SET(cpu, &cpuset);
+      pthread_setaffinity_np(thread.native_handle(), sizeof(cpuset), &cpuset);
+      return;
+    }
+  }
+#elif defined(_WIN32)
+  const size_t nb_cpu = std::min<size_t>(std::max(1u, std::thread::hardware_concurrency()), 8 * sizeof(DWORD_PTR));
+  SetThreadAffinityMask(thread.native_handle(), DWORD_PTR(1) << (k % nb_cpu));
+#endif
+}
+
+
+// Number of queries per batch of run_batches, a tile is never larger than
+// a thread range (small searches still use all nThreads)
+inline size_t batch_size(size_t n_points, size_t nThreads, size_t tile_size) {
+  const size_t rangeSize = std::max<size_t>(1, (n_points + nThreads - 1) / nThreads);
+  if (tile_size > 0)
+    return std::min(tile_size, rangeSize);
+  return rangeSize;
+}
+
+// Number of batches of run_batches
+inline size_t nb_batches(size_t n_points, size_t nThreads, size_t tile_size) {
+  const size_t batchSize = batch_size(n_points, nThreads, tile_size);
+  return (n_points + batchSize - 1) / batchSize;
+}
+
+// Run batch(b, startIdx, endIdx) for each batch b of [0, n_points) with at
+// most nThreads workers (never more workers than batches).
+// With tile_size > 0, workers take tiles of tile_size queries from a shared
+// counter (queries of a tile stay in cache while they walk the tree),
+// otherwise each worker gets one contiguous range.
+template <typename Batch>
+void run_batches(Batch &batch, size_t n_points, size_t nThreads, size_t tile_size,
+                 bool thread_affinity) {
+  const size_t batchSize = batch_size(n_points, nThreads, tile_size);
+  const size_t nbBatches = nb_batches(n_points, nThreads, tile_size);
+  const size_t nbWorkers = std::min(nThreads, nbBatches);
+
+  std::vector<std::thread> threadPool;
+  std::atomic<size_t> next_tile(0);
+  auto tileWorker = [&]() {
+    size_t b;
+    while ((b = next_tile.fetch_add(1)) < nbBatches) {
+      batch(b, b * batchSize, std::min((b + 1) * batchSize, n_points));
+    }
+  };
+
+  for (size_t i = 0; i < nbWorkers; i++) {
+    if (tile_size > 0) {
+      threadPool.push_back(std::thread(tileWorker));
+    }
+    else {
+      size_t startIdx = i * batchSize;
+      size_t endIdx = std::min((i + 1) * batchSize, n_points);
+      threadPool.push_back(std::thread(batch, i, startIdx, endIdx));
+    }
+    if (thread_affinity)
+      set_thread_affinity(threadPool.back(), i);
+  }
+  for (auto &t : threadPool) {
+    t.join();
+  }
+}
+
+
+// Matches of a batch of queries, gathered by a single worker
+template <typename num_t>
+struct BatchResults {
+  std::vector<size_t> indices;
+  std::vector<num_t> dists;
+};
+
+// Radius result set writing into caller owned buffers (no allocation):
+// every match is counted, only the first max_k are stored
+template <typename num_t>
+class RadiusResultBuffer {
+ public:
+  const num_t radius;
+  int64_t *out_idx;
+  num_t *out_dist;
+  const size_t max_k;
+  size_t count = 0;
+
+  RadiusResultBuffer(num_t radius, int64_t *out_idx, num_t *out_dist, size_t max_k)
+      : radius(radius), out_idx(out_idx), out_dist(out_dist), max_k(max_k) {}
+
+  inline void init() { count = 0; }
+  inline size_t size() const { return count; }
+  inline bool full() const { return true; }
+
+  inline bool addPoint(num_t dist, size_t index) {
+    if (dist < radius) {
+      if (count < max_k) {
+        out_idx[count] = index;
+        out_dist[count] = dist;
+      }
+      count++;
+    }
+    return true;
+  }
+
+  inline num_t worstDist() const { return radius; }
+};
+
+
 template <typename num_t>
 class AbstractKDTree {
  public:
@@ -33,6 +170,8 @@ class AbstractKDTree {
       const num_t *query, num_t radius,
       std::vector<size_t> &ret_matches,
       nanoflann::SearchParams params) = 0;
+  virtual size_t radiusSearchBuffer(
+      const num_t *query, RadiusResultBuffer<num_t> &result) const = 0;
   virtual void knnSearch(const num_t *query, size_t num_closest,
                          size_t *out_indices, num_t *out_distances_sq) = 0;
   virtual int saveIndex(const std::string &path) const = 0;
@@ -45,6 +184,9 @@ class AbstractKDTree {
   virtual num_t scale_radius_full(const num_t radius) const = 0;
   virtual void buildIndex() = 0;
   virtual ~AbstractKDTree(){};
+
+  // squared distances ("l2sq"): radius and results are not rescaled
+  bool squared = false;
 };
 
 
@@ -92,6 +234,11 @@ struct KDTreeNumpyAdaptor : public AbstractKDTree<num_t> {
     return index->radiusSearchIdx(query, radius, ret_matches, params);
   }
 
+  size_t radiusSearchBuffer(const num_t *query, RadiusResultBuffer<num_t> &result) const {
+    index->findNeighbors(result, query, nanoflann::SearchParams());
+    return result.size();
+  }
+
   const self_t &derived() const { return *this; }
   self_t &derived() { return *this; }
 
@@ -114,11 +261,11 @@ struct KDTreeNumpyAdaptor : public AbstractKDTree<num_t> {
   }
 
   inline int get_radius_exp() const {
-    return index->distance.dist_exponent;
+    return this->squared ? 1 : index->distance.dist_exponent;
   }
 
   inline int get_radius_full_exp() const {
-    return index->distance.pair_exponent;
+    return this->squared ? 1 : index->distance.pair_exponent;
   }
 
   inline num_t scale_radius(const num_t radius) const {
@@ -161,7 +308,7 @@ class KDTree {
 
   KDTree(size_t n_neighbors = 10, size_t leaf_size = 10, std::string metric = "l2", num_t radius = 1.0f);
   ~KDTree() { delete index; }
-  void fit(f_np_arr_t points, std::string index_path, size_t ndim = 1);
+  void fit(f_np_arr_t points, std::string index_path, size_t ndim = 1, bool soa = false);
 
   // kneighbors search
   std::pair<f_np_arr_t, i_np_arr_t> kneighbors(f_np_arr_t array, size_t n_neighbors);
@@ -170,16 +317,16 @@ class KDTree {
 
 
   // radius search
-  void radius_neighbors_idx(f_np_arr_t, num_t radius = 1.0f);
-  void radius_neighbors_idx_dists(f_np_arr_t, num_t radius = 1.0f);
+  void radius_neighbors_idx(f_np_arr_t, num_t radius = 1.0f, size_t nnz_per_query = 0);
+  void radius_neighbors_idx_dists(f_np_arr_t, num_t radius = 1.0f, size_t nnz_per_query = 0);
   void radius_neighbors_idx_dists_full(f_np_arr_t arr, f_np_arr_t full_tree,
     f_np_arr_t full_arr, num_t radius = 1.0f, num_t radius_full = 1.0f);
   void radius_neighbors_idx_dists_full_multithreaded(f_np_arr_t arr, f_np_arr_t full_tree,
     f_np_arr_t full_arr, num_t radius = 1.0f, num_t radius_full = 1.0f, size_t nThreads = 1);
   void radius_neighbors_idx_multithreaded(
-      f_np_arr_t array, num_t radius = 1.0f, size_t nThreads = 1);
+      f_np_arr_t array, num_t radius = 1.0f, size_t nThreads = 1, size_t nnz_per_query = 0);
   void radius_neighbors_idx_dists_multithreaded(
-      f_np_arr_t array, num_t radius = 1.0f, size_t nThreads = 1);
+      f_np_arr_t array, num_t radius = 1.0f, size_t nThreads = 1, size_t nnz_per_query = 0);
 
   int save_index(const std::string &path);
 
@@ -187,21 +334,40 @@ class KDTree {
 
   // result getter
   i_np_arr_t getResultLenghts();
-  i_np_arr_t getResultIndicesPtr();
-  i_np_arr_t getResultIndicesRow();
-  i_np_arr_t getResultIndicesCol();
-  f_np_arr_t getResultDists();
+  r_np_arr_t getResultIndicesPtr(bool take = false);
+  r_np_arr_t getResultIndicesRow(bool take = false);
+  r_np_arr_t getResultIndicesCol(bool take = false);
+  f_np_arr_t getResultDists(bool take = false);
   f_np_arr_t getResultRawDists();
+  size_t getResultSize() const;
+  pybind11::tuple getResultArrays(bool with_rows = true, bool with_ptr = true, bool take = false);
+  void resetResults();
+  void mergeBatchResults(std::vector<BatchResults<num_t>> &batches, size_t nThreads);
 
   size_t n_neighbors;
   size_t leaf_size;
   std::string metric;
   num_t radius;
+  bool thread_affinity = false;
+  size_t tile_size = 0;
 
   std::vector<size_t> m_nbmatches;
   std::vector<std::vector<size_t>> m_indices;
   std::vector<std::vector<num_t>> m_dists;
   int dists_exponent = 0;
+
+  // flattened results, lazily built by the getters
+  std::shared_ptr<std::vector<r_idx_t>> m_res_ptr;
+  std::shared_ptr<std::vector<r_idx_t>> m_res_rows;
+  std::shared_ptr<std::vector<r_idx_t>> m_res_cols;
+  std::shared_ptr<std::vector<num_t>> m_res_dists;
+
+  // multithreaded searches store their matches already flattened
+  // (m_flat_cols and m_raw_dists) instead of m_indices / m_dists,
+  // m_flat_cols stays the source of m_res_cols when it is taken
+  bool m_flat_results = false;
+  std::shared_ptr<std::vector<r_idx_t>> m_flat_cols;
+  std::vector<num_t> m_raw_dists;
 };
 
 
@@ -215,7 +381,7 @@ KDTree<num_t>::KDTree(size_t n_neighbors, size_t leaf_size, std::string metric,
 
 
 template <typename num_t>
-void KDTree<num_t>::fit(f_np_arr_t points, std::string index_path, size_t ndim) {
+void KDTree<num_t>::fit(f_np_arr_t points, std::string index_path, size_t ndim, bool soa) {
   // Dynamic template instantiation for the popular use cases
   // separate in   ndim x mdim = total_dim
   const int total_dim = points.shape(1);
@@ -251,12 +417,21 @@ void KDTree<num_t>::fit(f_np_arr_t points, std::string index_path, size_t ndim)
       case 8:
         index = new KDTreeNumpyAdaptor<num_t, 8, nanoflann::metric_L1_8D>(points, leaf_size);
         break;
+      case 9:
+        index = new KDTreeNumpyAdaptor<num_t, 9, nanoflann::metric_L1_Fixed<9>>(points, leaf_size);
+        break;
+      case 12:
+        index = new KDTreeNumpyAdaptor<num_t, 12, nanoflann::metric_L1_Fixed<12>>(points, leaf_size);
+        break;
+      case 16:
+        index = new KDTreeNumpyAdaptor<num_t, 16, nanoflann::metric_L1_Fixed<16>>(points, leaf_size);
+        break;
       default:
         index = new KDTreeNumpyAdaptor<num_t, -1, nanoflann::metric_L1_ND>(points, leaf_size);
         break;
     }
   }
-  else if (metric == "l2" || metric == "l22") {
+  else if (metric == "l2" || metric == "l22" || metric == "l2sq") {
     switch (total_dim) {
       case 1:
         index = new KDTreeNumpyAdaptor<num_t, 1, nanoflann::metric_L2_1D>(points, leaf_size);
@@ -282,11 +457,37 @@ void KDTree<num_t>::fit(f_np_arr_t points, std::string index_path, size_t ndim)
       case 8:
         index = new KDTreeNumpyAdaptor<num_t, 8, nanoflann::metric_L2_8D>(points, leaf_size);
         break;
+      case 9:
+        index = new KDTreeNumpyAdaptor<num_t, 9, nanoflann::metric_L2_Fixed<9>>(points, leaf_size);
+        break;
+      case 12:
+        index = new KDTreeNumpyAdaptor<num_t, 12, nanoflann::metric_L2_Fixed<12>>(points, leaf_size);
+        break;
+      case 16:
+        index = new KDTreeNumpyAdaptor<num_t, 16, nanoflann::metric_L2_Fixed<16>>(points, leaf_size);
+        break;
       default:
         index = new KDTreeNumpyAdaptor<num_t, -1, nanoflann::metric_L2_ND>(points, leaf_size);
         break;
     }
   }
+  else if (metric == "l21" && soa && ndim > 1) {
+    // points given as [x_0, ..., x_M, y_0, ..., y_M, ...]
+    switch (ndim) {
+      case 2:
+        index = new KDTreeNumpyAdaptor<num_t, -1, nanoflann::metric_L21_M_2D_SoA>(points, leaf_size);
+        break;
+      case 3:
+        index = new KDTreeNumpyAdaptor<num_t, -1, nanoflann::metric_L21_M_3D_SoA>(points, leaf_size);
+        break;
+      case 4:
+        index = new KDTreeNumpyAdaptor<num_t, -1, nanoflann::metric_L21_M_4D_SoA>(points, leaf_size);
+        break;
+      default:
+        throw std::runtime_error("l21 is only supported with 2D, 3D or 4D points (from numpy.shape[3])");
+        break;
+    }
+  }
   else if (metric == "l21") {
     switch (ndim) {
       case 1:
@@ -370,6 +571,8 @@ void KDTree<num_t>::fit(f_np_arr_t points, std::string index_path, size_t ndim)
     throw std::runtime_error("L12 is not yet supported");
   }
 
+  index->squared = (metric == "l2sq");
+
   if (index_path.size()) {
     index->loadIndex(index_path);
   } else {
@@ -407,7 +610,7 @@ KDTree<num_t>::kneighbors(f_np_arr_t array, size_t n_neighbors) {
 
 template <typename num_t>
 void KDTree<num_t>::radius_neighbors_idx(
-    f_np_arr_t array, num_t radius) {
+    f_np_arr_t array, num_t radius, size_t nnz_per_query) {
   const auto mat = array.template unchecked<2>();
   const num_t *query_data = mat.data(0, 0);
   const size_t n_points = mat.shape(0);
@@ -415,12 +618,14 @@ void KDTree<num_t>::radius_neighbors_idx(
 
   const num_t search_radius = index->scale_radius(radius);
 
+  this->resetResults();
   this->m_nbmatches.resize(n_points);
   this->m_indices.resize(n_points);
   this->m_dists.clear();
   this->dists_exponent = 0;
 
   for (size_t i = 0; i < n_points; i++) {
+    this->m_indices[i].reserve(nnz_per_query);
     this->m_nbmatches[i] = index->radiusSearchIdx(
         &query_data[i * dim], search_radius, this->m_indices[i], nanoflann::SearchParams());
   }
@@ -428,7 +633,7 @@ void KDTree<num_t>::radius_neighbors_idx(
 }
 
 template <typename num_t>
-void KDTree<num_t>::radius_neighbors_idx_dists(f_np_arr_t array, num_t radius) {
+void KDTree<num_t>::radius_neighbors_idx_dists(f_np_arr_t array, num_t radius, size_t nnz_per_query) {
   const auto mat = array.template unchecked<2>();
   const num_t *query_data = mat.data(0, 0);
   const size_t n_points = mat.shape(0);
@@ -437,6 +642,8 @@ void KDTree<num_t>::radius_neighbors_idx_dists(f_np_arr_t array, num_t radius) {
 
   const num_t search_radius = index->scale_radius(radius);
   std::vector<std::pair<size_t, num_t>> ret_matches;
+  ret_matches.reserve(nnz_per_query);
+  this->resetResults();
   this->m_nbmatches.resize(n_points);
   this->m_indices.resize(n_points);
   this->m_dists.resize(n_points);
@@ -458,7 +665,7 @@ void KDTree<num_t>::radius_neighbors_idx_dists(f_np_arr_t array, num_t radius) {
 }
 
 template <typename num_t>
-void KDTree<num_t>::radius_neighbors_idx_multithreaded(f_np_arr_t array, num_t radius, size_t nThreads) {
+void KDTree<num_t>::radius_neighbors_idx_multithreaded(f_np_arr_t array, num_t radius, size_t nThreads, size_t nnz_per_query) {
 
   const auto mat = array.template unchecked<2>();
   const num_t *query_data = mat.data(0, 0);
@@ -468,36 +675,36 @@ void KDTree<num_t>::radius_neighbors_idx_multithreaded(f_np_arr_t array, num_t r
 
   const num_t search_radius = index->scale_radius(radius);
 
+  this->resetResults();
   this->m_nbmatches.resize(n_points);
-  this->m_indices.resize(n_points);
+  this->m_indices.clear();
   this->m_dists.clear();
-  this->dists_exponent = index->get_radius_exp();
+  this->dists_exponent = 0;
 
-  auto searchBatch = [&](size_t startIdx, size_t endIdx) {
+  // each batch gathers its matches in its own buffer (no shared allocation)
+  std::vector<BatchResults<num_t>> batches(nb_batches(n_points, nThreads, this->tile_size));
+
+  auto searchBatch = [&](size_t b, size_t startIdx, size_t endIdx) {
+    BatchResults<num_t> &res = batches[b];
+    std::vector<size_t> ret_matches;
+    ret_matches.reserve(nnz_per_query);
+    res.indices.reserve(nnz_per_query * (endIdx - startIdx));
     for (size_t i = startIdx; i < endIdx; i++) {
       this->m_nbmatches[i] = index->radiusSearchIdx(
-          &query_data[i * dim], search_radius, this->m_indices[i], nanoflann::SearchParams());
+          &query_data[i * dim], search_radius, ret_matches, nanoflann::SearchParams());
+      res.indices.insert(res.indices.end(), ret_matches.begin(), ret_matches.end());
     }
   };
 
-  std::vector<std::thread> threadPool;
-  size_t batchSize = std::ceil(static_cast<float>(n_points) / nThreads);
-  for (size_t i = 0; i < nThreads; i++) {
-    size_t startIdx = i * batchSize;
-    size_t endIdx = (i + 1) * batchSize;
-    endIdx = std::min(endIdx, n_points);
-    threadPool.push_back(std::thread(searchBatch, startIdx, endIdx));
-  }
-  for (auto &t : threadPool) {
-    t.join();
-  }
+  run_batches(searchBatch, n_points, nThreads, this->tile_size, this->thread_affinity);
+  this->mergeBatchResults(batches, nThreads);
 
   return;
 }
 
 
 template <typename num_t>
-void KDTree<num_t>::radius_neighbors_idx_dists_multithreaded(f_np_arr_t array, num_t radius, size_t nThreads) {
+void KDTree<num_t>::radius_neighbors_idx_dists_multithreaded(f_np_arr_t array, num_t radius, size_t nThreads, size_t nnz_per_query) {
   // reset search results
 
   const auto mat = array.template unchecked<2>();
@@ -507,39 +714,35 @@ void KDTree<num_t>::radius_neighbors_idx_dists_multithreaded(f_np_arr_t array, n
 
 
   const num_t search_radius = index->scale_radius(radius);
-  std::vector<std::pair<size_t, num_t>> ret_matches;
 
+  this->resetResults();
   this->m_nbmatches.resize(n_points);
-  this->m_indices.resize(n_points);
-  this->m_dists.resize(n_points);
+  this->m_indices.clear();
+  this->m_dists.clear();
   this->dists_exponent = index->get_radius_exp();
 
-  auto searchBatch = [&](size_t startIdx, size_t endIdx) {
+  // each batch gathers its matches in its own buffers (no shared allocation)
+  std::vector<BatchResults<num_t>> batches(nb_batches(n_points, nThreads, this->tile_size));
+
+  auto searchBatch = [&](size_t b, size_t startIdx, size_t endIdx) {
+    BatchResults<num_t> &res = batches[b];
     std::vector<std::pair<size_t, num_t>> ret_matches;
+    ret_matches.reserve(nnz_per_query);
+    res.indices.reserve(nnz_per_query * (endIdx - startIdx));
+    res.dists.reserve(nnz_per_query * (endIdx - startIdx));
     for (size_t i = startIdx; i < endIdx; i++) {
       const size_t nb_match = index->radiusSearch(&query_data[i * dim], search_radius, ret_matches, nanoflann::SearchParams());
 
       this->m_nbmatches[i] = nb_match;
-      this->m_indices[i].resize(nb_match);
-      this->m_dists[i].resize(nb_match);
       for (size_t j = 0; j < nb_match; j++) {
-        this->m_indices[i][j] = ret_matches[j].first;
-        this->m_dists[i][j] = ret_matches[j].second;
+        res.indices.push_back(ret_matches[j].first);
+        res.dists.push_back(ret_matches[j].second);
       }
     }
   };
 
-  std::vector<std::thread> threadPool;
-  size_t batchSize = std::ceil(static_cast<float>(n_points) / nThreads);
-  for (size_t i = 0; i < nThreads; i++) {
-    size_t startIdx = i * batchSize;
-    size_t endIdx = (i + 1) * batchSize;
-    endIdx = std::min(endIdx, n_points);
-    threadPool.push_back(std::thread(searchBatch, startIdx, endIdx));
-  }
-  for (auto &t : threadPool) {
-    t.join();
-  }
+  run_batches(searchBatch, n_points, nThreads, this->tile_size, this->thread_affinity);
+  this->mergeBatchResults(batches, nThreads);
 
   return;
 }
@@ -558,7 +761,7 @@ KDTree<num_t>::kneighbors_multithreaded(f_np_arr_t array, size_t n_neighbors, si
   num_t *res_dis_data = results_dists.template mutable_unchecked<2>().mutable_data(0, 0);
   size_t *res_idx_data = results_idxs.template mutable_unchecked<2>().mutable_data(0, 0);
 
-  auto searchBatch = [&](size_t startIdx, size_t endIdx) {
+  auto searchBatch = [&](size_t, size_t startIdx, size_t endIdx) {
     for (size_t i = startIdx; i < endIdx; i++) {
       const num_t *query_point = &query_data[i * dim];
       index->knnSearch(query_point, n_neighbors, &res_idx_data[i * n_neighbors],
@@ -566,17 +769,7 @@ KDTree<num_t>::kneighbors_multithreaded(f_np_arr_t array, size_t n_neighbors, si
     }
   };
 
-  std::vector<std::thread> threadPool;
-  size_t batchSize = std::ceil(static_cast<float>(n_points) / nThreads);
-  for (size_t i = 0; i < nThreads; i++) {
-    size_t startIdx = i * batchSize;
-    size_t endIdx = (i + 1) * batchSize;
-    endIdx = std::min(endIdx, n_points);
-    threadPool.push_back(std::thread(searchBatch, startIdx, endIdx));
-  }
-  for (auto &t : threadPool) {
-    t.join();
-  }
+  run_batches(searchBatch, n_points, nThreads, this->tile_size, this->thread_affinity);
 
   return std::make_pair(results_dists, results_idxs);
 }
@@ -588,76 +781,160 @@ int KDTree<num_t>::save_index(const std::string &path) {
 
 
 // ESO Getter for results in python
+// Flattened results are built once per search and shared (read-only, no copy)
+// with every numpy array returned by the getters.
+// With take, the array owns its (writable) buffer instead: the cached buffer
+// is handed over and dropped from the cache, or copied if still shared.
+template <typename T>
+pybind11::array_t<T> result_as_array(std::shared_ptr<std::vector<T>> &vec, bool take) {
+  std::shared_ptr<std::vector<T>> buffer = vec;
+  if (take) {
+    vec.reset();
+    if (buffer.use_count() > 1) {
+      buffer = std::make_shared<std::vector<T>>(*buffer);
+    }
+  }
+  auto *owner = new std::shared_ptr<std::vector<T>>(buffer);
+  auto capsule = pybind11::capsule(owner, [](void* p) { delete reinterpret_cast<std::shared_ptr<std::vector<T>>*>(p); });
+  pybind11::array_t<T> arr(buffer->size(), buffer->data(), capsule);
+  if (!take) {
+    arr.attr("setflags")(pybind11::arg("write") = false);
+  }
+  return arr;
+}
+
+template <typename num_t>
+void KDTree<num_t>::resetResults(){
+  this->m_res_ptr.reset();
+  this->m_res_rows.reset();
+  this->m_res_cols.reset();
+  this->m_res_dists.reset();
+  this->m_flat_cols.reset();
+  std::vector<num_t>().swap(this->m_raw_dists);
+  this->m_flat_results = false;
+}
+
+// Concatenate the batches (in query order) into the flattened results,
+// each worker copies a range of batches
+template <typename num_t>
+void KDTree<num_t>::mergeBatchResults(std::vector<BatchResults<num_t>> &batches, size_t nThreads) {
+  std::vector<size_t> offsets(batches.size() + 1, 0);
+  for (size_t b = 0; b < batches.size(); ++b) {
+    offsets[b + 1] = offsets[b] + batches[b].indices.size();
+  }
+
+  // idx-only searches have no distances (dists_exponent = 0)
+  auto cols = std::make_shared<std::vector<r_idx_t>>(offsets.back());
+  if (this->dists_exponent > 0)
+    this->m_raw_dists.resize(offsets.back());
+
+  auto copyBatches = [&](size_t, size_t startIdx, size_t endIdx) {
+    for (size_t b = startIdx; b < endIdx; ++b) {
+      std::copy(batches[b].indices.begin(), batches[b].indices.end(), cols->begin() + offsets[b]);
+      std::copy(batches[b].dists.begin(), batches[b].dists.end(), this->m_raw_dists.begin() + offsets[b]);
+      batches[b] = BatchResults<num_t>();
+    }
+  };
+  run_batches(copyBatches, batches.size(), nThreads, 0, this->thread_affinity);
+
+  this->m_flat_cols = cols;
+  this->m_flat_results = true;
+}
+
+template <typename num_t>
+size_t KDTree<num_t>::getResultSize() const{
+  return std::accumulate(this->m_nbmatches.begin(), this->m_nbmatches.end(), size_t(0));
+}
+
 template <typename num_t>
 i_np_arr_t KDTree<num_t>::getResultLenghts(){
   return pybind11::array(this->m_nbmatches.size(), this->m_nbmatches.data());
 }
 
 template <typename num_t>
-i_np_arr_t KDTree<num_t>::getResultIndicesPtr(){
-  const size_t n_points = this->m_nbmatches.size();
-  std::vector<size_t>* seq_ptr = new std::vector<size_t>(n_points + 1);
+r_np_arr_t KDTree<num_t>::getResultIndicesPtr(bool take){
+  if (!this->m_res_ptr) {
+    const size_t n_points = this->m_nbmatches.size();
+    auto seq_ptr = std::make_shared<std::vector<r_idx_t>>(n_points + 1);
 
-  // reformating in a single array
-  (*seq_ptr)[0] = 0;
-  for (size_t i = 0; i < n_points; ++i) {
-    (*seq_ptr)[i+1] = (*seq_ptr)[i] + this->m_nbmatches[i];
+    // reformating in a single array
+    (*seq_ptr)[0] = 0;
+    for (size_t i = 0; i < n_points; ++i) {
+      (*seq_ptr)[i+1] = (*seq_ptr)[i] + this->m_nbmatches[i];
+    }
+    this->m_res_ptr = seq_ptr;
   }
-
-  auto capsule = pybind11::capsule(seq_ptr, [](void* p) { delete reinterpret_cast<std::vector<size_t>*>(p); });
-  return pybind11::array(seq_ptr->size(),seq_ptr->data(), capsule);
+  return result_as_array(this->m_res_ptr, take);
 }
 
 template <typename num_t>
-i_np_arr_t KDTree<num_t>::getResultIndicesRow(){
-  const size_t n_points = this->m_nbmatches.size();
-  const size_t total_nb_match = std::accumulate(this->m_nbmatches.begin(), this->m_nbmatches.end(), 0);
-  std::vector<size_t>* seq_ptr = new std::vector<size_t>(total_nb_match);
-  size_t d = 0;
+r_np_arr_t KDTree<num_t>::getResultIndicesRow(bool take){
+  if (!this->m_res_rows) {
+    const size_t n_points = this->m_nbmatches.size();
+    auto seq_ptr = std::make_shared<std::vector<r_idx_t>>(this->getResultSize());
+    size_t d = 0;
 
-  // reformating in a single array
-  for (size_t i = 0; i < n_points; ++i) {
-    const size_t nb_match = this->m_nbmatches[i];
-    for (size_t j = 0; j < nb_match; ++j) {
-      (*seq_ptr)[d++] = i;
+    // reformating in a single array
+    for (size_t i = 0; i < n_points; ++i) {
+      const size_t nb_match = this->m_nbmatches[i];
+      for (size_t j = 0; j < nb_match; ++j) {
+        (*seq_ptr)[d++] = i;
+      }
     }
+    this->m_res_rows = seq_ptr;
   }
-
-  auto capsule = pybind11::capsule(seq_ptr, [](void* p) { delete reinterpret_cast<std::vector<size_t>*>(p); });
-  return pybind11::array(seq_ptr->size(),seq_ptr->data(), capsule);
+  return result_as_array(this->m_res_rows, take);
 }
 
 template <typename num_t>
-i_np_arr_t KDTree<num_t>::getResultIndicesCol(){
-  const size_t n_points = this->m_nbmatches.size();
-  const size_t total_nb_match = std::accumulate(this->m_nbmatches.begin(), this->m_nbmatches.end(), 0);
-  std::vector<size_t>* seq_ptr = new std::vector<size_t>(total_nb_match);
-  size_t d = 0;
+r_np_arr_t KDTree<num_t>::getResultIndicesCol(bool take){
+  if (!this->m_res_cols && this->m_flat_results) {
+    this->m_res_cols = this->m_flat_cols;
+  }
+  else if (!this->m_res_cols) {
+    const size_t n_points = this->m_nbmatches.size();
+    auto seq_ptr = std::make_shared<std::vector<r_idx_t>>(this->getResultSize());
+    size_t d = 0;
 
-  // reformating in a single array
-  for (size_t i = 0; i < n_points; ++i) {
-    const size_t nb_match = this->m_nbmatches[i];
-    for (size_t j = 0; j < nb_match; ++j) {
-      (*seq_ptr)[d++] = this->m_indices[i][j];
+    // reformating in a single array
+    for (size_t i = 0; i < n_points; ++i) {
+      const size_t nb_match = this->m_nbmatches[i];
+      for (size_t j = 0; j < nb_match; ++j) {
+        (*seq_ptr)[d++] = this->m_indices[i][j];
+      }
     }
+    this->m_res_cols = seq_ptr;
   }
-
-  auto capsule = pybind11::capsule(seq_ptr, [](void* p) { delete reinterpret_cast<std::vector<size_t>*>(p); });
-  return pybind11::array(seq_ptr->size(),seq_ptr->data(), capsule);
+  return result_as_array(this->m_res_cols, take);
 }
 
 
 template <typename num_t>
-pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast> KDTree<num_t>::getResultDists(){
+pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast> KDTree<num_t>::getResultDists(bool take){
+  if (this->m_res_dists) {
+    return result_as_array(this->m_res_dists, take);
+  }
+
   const size_t n_points = this->m_nbmatches.size();
-  const size_t total_nb_match = std::accumulate(this->m_nbmatches.begin(), this->m_nbmatches.end(), 0);
-  std::vector<num_t>* seq_ptr = new std::vector<num_t>(total_nb_match);
+  auto seq_ptr = std::make_shared<std::vector<num_t>>(this->getResultSize());
   size_t d = 0;
 
   // reformating in a single array
   if(this->dists_exponent < 1){
       throw std::runtime_error("Error: dists_exponent < 0, need to be set for the chosen distance");
   }
+  else if(this->m_flat_results){
+    const int exponent = this->dists_exponent;
+    const std::vector<num_t> &raw = this->m_raw_dists;
+    for (size_t k = 0; k < raw.size(); ++k) {
+      if (exponent == 1)
+        (*seq_ptr)[k] = raw[k];
+      else if (exponent == 2)
+        (*seq_ptr)[k] = std::sqrt(raw[k]);
+      else
+        (*seq_ptr)[k] = std::pow(raw[k], 1.0/exponent);
+    }
+  }
   else if(this->dists_exponent == 1){
     for (size_t i = 0; i < n_points; ++i) {
       const size_t nb_match = this->m_nbmatches[i];
@@ -683,20 +960,24 @@ pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast>
     }
   }
 
-  auto capsule = pybind11::capsule(seq_ptr, [](void* p) { delete reinterpret_cast<std::vector<num_t>*>(p); });
-  return pybind11::array(seq_ptr->size(),seq_ptr->data(), capsule);
+  this->m_res_dists = seq_ptr;
+  return result_as_array(this->m_res_dists, take);
 }
 
 
 template <typename num_t>
 pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast> KDTree<num_t>::getResultRawDists(){
+  if (this->dists_exponent < 1)
+    throw std::runtime_error("Error: no distances, the last search did not compute them");
+
   const size_t n_points = this->m_nbmatches.size();
-  const size_t total_nb_match = std::accumulate(this->m_nbmatches.begin(), this->m_nbmatches.end(), 0);
-  std::vector<num_t>* seq_ptr = new std::vector<num_t>(total_nb_match);
+  std::vector<num_t>* seq_ptr = new std::vector<num_t>(this->getResultSize());
   size_t d = 0;
 
   // reformating in a single array
-  for (size_t i = 0; i < n_points; ++i) {
+  if (this->m_flat_results)
+    std::copy(this->m_raw_dists.begin(), this->m_raw_dists.end(), seq_ptr->begin());
+  else for (size_t i = 0; i < n_points; ++i) {
     const size_t nb_match = this->m_nbmatches[i];
     for (size_t j = 0; j < nb_match; ++j) {
       (*seq_ptr)[d++] = this->m_dists[i][j];
@@ -707,6 +988,18 @@ pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast>
   return pybind11::array(seq_ptr->size(),seq_ptr->data(), capsule);
 }
 
+// (dists, rows, cols, ptr) in a single call, skipped arrays are None
+template <typename num_t>
+pybind11::tuple KDTree<num_t>::getResultArrays(bool with_rows, bool with_ptr, bool take){
+  pybind11::object rows = pybind11::none();
+  pybind11::object ptr = pybind11::none();
+  if (with_rows)
+    rows = this->getResultIndicesRow(take);
+  if (with_ptr)
+    ptr = this->getResultIndicesPtr(take);
+  return pybind11::make_tuple(this->getResultDists(take), rows, this->getResultIndicesCol(take), ptr);
+}
+
 template <typename num_t>
 void KDTree<num_t>::radius_neighbors_idx_dists_full(f_np_arr_t array, f_np_arr_t full_tree, f_np_arr_t full_array, num_t radius, num_t radius_full) {
   const auto mat = array.template unchecked<2>();
@@ -726,6 +1019,7 @@ void KDTree<num_t>::radius_neighbors_idx_dists_full(f_np_arr_t array, f_np_arr_t
   const num_t search_radius_full = index->scale_radius_full(radius_full);
 
   std::vector<std::pair<size_t, num_t>> ret_matches;
+  this->resetResults();
   this->m_nbmatches.resize(n_points);
   this->m_indices.resize(n_points);
   this->m_dists.resize(n_points);
@@ -735,8 +1029,11 @@ void KDTree<num_t>::radius_neighbors_idx_dists_full(f_np_arr_t array, f_np_arr_t
     const size_t nb_match = index->radiusSearch(
         &query_data[i * dim], search_radius, ret_matches, nanoflann::SearchParams());
 
+    this->m_indices[i].clear();
+    this->m_dists[i].clear();
     for (size_t j = 0; j < nb_match; j++) {
-      full_dist = index->eval_pair(&query_full[i * full_dim], &query_fullt[ret_matches[j].first * full_dim], full_dim);
+      const size_t t_idx = ret_matches[j].first;
+      full_dist = index->eval_pair(&query_full[i * full_dim], &query_fullt[t_idx * full_dim], full_dim);
 
       if (full_dist < search_radius_full){
         this->m_indices[i].push_back(ret_matches[j].first);
@@ -766,85 +1063,193 @@ void KDTree<num_t>::radius_neighbors_idx_dists_full_multithreaded(f_np_arr_t arr
   const num_t search_radius = index->scale_radius(radius);
   const num_t search_radius_full = index->scale_radius_full(radius_full);
 
+  this->resetResults();
   this->m_nbmatches.resize(n_points);
-  this->m_indices.resize(n_points);
-  this->m_dists.resize(n_points);
+  this->m_indices.clear();
+  this->m_dists.clear();
   this->dists_exponent = index->get_radius_full_exp();
 
-  auto searchBatch = [&](size_t startIdx, size_t endIdx) {
+  std::vector<BatchResults<num_t>> batches(nb_batches(n_points, nThreads, this->tile_size));
+
+  auto searchBatch = [&](size_t b, size_t startIdx, size_t endIdx) {
+    BatchResults<num_t> &res = batches[b];
     std::vector<std::pair<size_t, num_t>> ret_matches;
     num_t full_dist;
     for (size_t i = startIdx; i < endIdx; i++) {
       const size_t nb_match = index->radiusSearch(&query_data[i * dim], search_radius, ret_matches, nanoflann::SearchParams());
+      const size_t nb_prev = res.indices.size();
 
-      this->m_indices[i].resize(0);
-      this->m_dists[i].clear();
       for (size_t j = 0; j < nb_match; j++) {
-        full_dist = index->eval_pair(&query_full[i * full_dim], &query_fullt[ret_matches[j].first * full_dim], full_dim);
+        const size_t t_idx = ret_matches[j].first;
+        full_dist = index->eval_pair(&query_full[i * full_dim], &query_fullt[t_idx * full_dim], full_dim);
 
         if (full_dist < search_radius_full){
-          this->m_indices[i].push_back(ret_matches[j].first);
-          this->m_dists[i].push_back(full_dist);
+          res.indices.push_back(t_idx);
+          res.dists.push_back(full_dist);
         }
       }
-      this->m_nbmatches[i] = this->m_indices[i].size();
+      this->m_nbmatches[i] = res.indices.size() - nb_prev;
     }
   };
 
-  std::vector<std::thread> threadPool;
-  size_t batchSize = std::ceil(static_cast<float>(n_points) / nThreads);
-  for (size_t i = 0; i < nThreads; i++) {
-    size_t startIdx = i * batchSize;
-    size_t endIdx = (i + 1) * batchSize;
-    endIdx = std::min(endIdx, n_points);
-    threadPool.push_back(std::thread(searchBatch, startIdx, endIdx));
+  run_batches(searchBatch, n_points, nThreads, this->tile_size, this->thread_affinity);
+  this->mergeBatchResults(batches, nThreads);
+
+  return;
+}
+
+// Mean-points: average each group of nb_averaged consecutive points,
+//   (n, nb_mpts*nb_averaged*last_dim) -> (n, nb_mpts*last_dim)
+template <typename num_t>
+pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast>
+mean_mpts(pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast> array,
+          size_t nb_mpts, size_t last_dim, size_t nThreads) {
+  const auto mat = array.template unchecked<2>();
+  const num_t *data = mat.data(0, 0);
+  const size_t n_points = mat.shape(0);
+  const size_t dim = mat.shape(1);
+
+  if (nb_mpts == 0 || last_dim == 0 || dim % (nb_mpts * last_dim) > 0)
+    throw std::runtime_error("Error: dim != nb_mpts * nb_averaged * last_dim");
+
+  const size_t nb_averaged = dim / (nb_mpts * last_dim);
+  const size_t out_dim = nb_mpts * last_dim;
+  const num_t inv_nb_averaged = num_t(1) / nb_averaged;
+
+  pybind11::array_t<num_t, pybind11::array::c_style | pybind11::array::forcecast> results({n_points, out_dim});
+  num_t *res_data = results.template mutable_unchecked<2>().mutable_data(0, 0);
+
+  auto meanBatch = [&](size_t, size_t startIdx, size_t endIdx) {
+    for (size_t i = startIdx; i < endIdx; i++) {
+      const num_t *row = &data[i * dim];
+      num_t *res_row = &res_data[i * out_dim];
+      for (size_t m = 0; m < nb_mpts; m++) {
+        const num_t *group = &row[m * nb_averaged * last_dim];
+        for (size_t d = 0; d < last_dim; d++) {
+          num_t s = 0;
+#pragma omp simd reduction(+:s)
+          for (size_t k = 0; k < nb_averaged; k++) {
+            s += group[k * last_dim + d];
+          }
+          res_row[m * last_dim + d] = s * inv_nb_averaged;
+        }
+      }
+    }
+  };
+
+  if (nThreads <= 1) {
+    meanBatch(0, 0, n_points);
+    return results;
   }
-  for (auto &t : threadPool) {
-    t.join();
+
+  run_batches(meanBatch, n_points, nThreads, 0, false);
+  return results;
+}
+
+
+// Single radius query on a fitted tree (tree_handle = KDTree.index), without
+// Python objects nor the GIL, to be called from numba cfunc / njit code.
+// Returns the number of neighbors within radius, the first max_k are written
+// in out_idx (int64) and out_dist (num_t, same scale as getResultDists).
+template <typename num_t>
+int64_t radius_single_query(void *tree_handle, const void *query, num_t radius,
+                            void *out_idx, void *out_dist, int64_t max_k) {
+  const AbstractKDTree<num_t> *index = static_cast<const AbstractKDTree<num_t> *>(tree_handle);
+  RadiusResultBuffer<num_t> result(index->scale_radius(radius), static_cast<int64_t *>(out_idx),
+                                   static_cast<num_t *>(out_dist), max_k > 0 ? max_k : 0);
+  const size_t nb_match = index->radiusSearchBuffer(static_cast<const num_t *>(query), result);
+
+  const int exponent = index->get_radius_exp();
+  const size_t nb_stored = std::min(nb_match, result.max_k);
+  num_t *dists = result.out_dist;
+  if (exponent == 2) {
+    for (size_t j = 0; j < nb_stored; ++j)
+      dists[j] = std::sqrt(dists[j]);
+  }
+  else if (exponent > 2) {
+    for (size_t j = 0; j < nb_stored; ++j)
+      dists[j] = std::pow(dists[j], 1.0 / exponent);
   }
+  return nb_match;
+}
 
-  return;
+extern "C" int64_t lpq_radius_single_query_f32(void *tree_handle, const void *query, float radius,
+                                               void *out_idx, void *out_dist, int64_t max_k) {
+  return radius_single_query<float>(tree_handle, query, radius, out_idx, out_dist, max_k);
+}
+
+extern "C" int64_t lpq_radius_single_query_f64(void *tree_handle, const void *query, double radius,
+                                               void *out_idx, void *out_dist, int64_t max_k) {
+  return radius_single_query<double>(tree_handle, query, radius, out_idx, out_dist, max_k);
 }
 
 
 PYBIND11_MODULE(nanoflann_ext, m) {
+  m.def("mean_mpts", &mean_mpts<float>);
+  m.def("mean_mpts", &mean_mpts<double>);
+  m.def("nb_batches", &nb_batches, pybind11::arg("n_points"), pybind11::arg("nThreads"), pybind11::arg("tile_size"));
+  m.def("radius_single_query_addr32",
+        []() { return reinterpret_cast<uintptr_t>(&lpq_radius_single_query_f32); });
+  m.def("radius_single_query_addr64",
+        []() { return reinterpret_cast<uintptr_t>(&lpq_radius_single_query_f64); });
+
   pybind11::class_<KDTree<float>>(m, "KDTree32")
       .def(pybind11::init<size_t, size_t, std::string, float>())
-      .def("fit", &KDTree<float>::fit)
+      .def("fit", &KDTree<float>::fit, pybind11::arg("points"), pybind11::arg("index_path"),
+           pybind11::arg("ndim") = 1, pybind11::arg("soa") = false)
       .def("kneighbors", &KDTree<float>::kneighbors)
       .def("kneighbors_multithreaded", &KDTree<float>::kneighbors_multithreaded)
-      .def("radius_neighbors_idx", &KDTree<float>::radius_neighbors_idx)
-      .def("radius_neighbors_idx_dists", &KDTree<float>::radius_neighbors_idx_dists)
-      .def("radius_neighbors_idx_multithreaded", &KDTree<float>::radius_neighbors_idx_multithreaded)
-      .def("radius_neighbors_idx_dists_multithreaded", &KDTree<float>::radius_neighbors_idx_dists_multithreaded)
+      .def("radius_neighbors_idx", &KDTree<float>::radius_neighbors_idx,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nnz_per_query") = 0)
+      .def("radius_neighbors_idx_dists", &KDTree<float>::radius_neighbors_idx_dists,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nnz_per_query") = 0)
+      .def("radius_neighbors_idx_multithreaded", &KDTree<float>::radius_neighbors_idx_multithreaded,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nThreads"), pybind11::arg("nnz_per_query") = 0)
+      .def("radius_neighbors_idx_dists_multithreaded", &KDTree<float>::radius_neighbors_idx_dists_multithreaded,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nThreads"), pybind11::arg("nnz_per_query") = 0)
       .def("radius_neighbors_idx_dists_full", &KDTree<float>::radius_neighbors_idx_dists_full)
       .def("radius_neighbors_idx_dists_full_multithreaded", &KDTree<float>::radius_neighbors_idx_dists_full_multithreaded)
       .def("getResultLenghts", &KDTree<float>::getResultLenghts)
-      .def("getResultIndicesPtr", &KDTree<float>::getResultIndicesPtr)
-      .def("getResultIndicesRow", &KDTree<float>::getResultIndicesRow)
-      .def("getResultIndicesCol", &KDTree<float>::getResultIndicesCol)
-      .def("getResultDists", &KDTree<float>::getResultDists)
+      .def("getResultIndicesPtr", &KDTree<float>::getResultIndicesPtr, pybind11::arg("take") = false)
+      .def("getResultIndicesRow", &KDTree<float>::getResultIndicesRow, pybind11::arg("take") = false)
+      .def("getResultIndicesCol", &KDTree<float>::getResultIndicesCol, pybind11::arg("take") = false)
+      .def("getResultDists", &KDTree<float>::getResultDists, pybind11::arg("take") = false)
       .def("getResultRawDists", &KDTree<float>::getResultRawDists)
-      .def("save_index", &KDTree<float>::save_index);
+      .def("getResultArrays", &KDTree<float>::getResultArrays,
+           pybind11::arg("with_rows") = true, pybind11::arg("with_ptr") = true, pybind11::arg("take") = false)
+      .def("save_index", &KDTree<float>::save_index)
+      .def("get_handle", [](const KDTree<float> &t) { return reinterpret_cast<uintptr_t>(t.index); })
+      .def_readwrite("thread_affinity", &KDTree<float>::thread_affinity)
+      .def_readwrite("tile_size", &KDTree<float>::tile_size);
 
   pybind11::class_<KDTree<double>>(m, "KDTree64")
       .def(pybind11::init<size_t, size_t, std::string, float>())
-      .def("fit", &KDTree<double>::fit)
+      .def("fit", &KDTree<double>::fit, pybind11::arg("points"), pybind11::arg("index_path"),
+           pybind11::arg("ndim") = 1, pybind11::arg("soa") = false)
       .def("kneighbors", &KDTree<double>::kneighbors)
       .def("kneighbors_multithreaded",
            &KDTree<double>::kneighbors_multithreaded)
-      .def("radius_neighbors_idx", &KDTree<double>::radius_neighbors_idx)
-      .def("radius_neighbors_idx_dists", &KDTree<double>::radius_neighbors_idx_dists)
-      .def("radius_neighbors_idx_multithreaded", &KDTree<double>::radius_neighbors_idx_multithreaded)
-      .def("radius_neighbors_idx_dists_multithreaded", &KDTree<double>::radius_neighbors_idx_dists_multithreaded)
+      .def("radius_neighbors_idx", &KDTree<double>::radius_neighbors_idx,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nnz_per_query") = 0)
+      .def("radius_neighbors_idx_dists", &KDTree<double>::radius_neighbors_idx_dists,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nnz_per_query") = 0)
+      .def("radius_neighbors_idx_multithreaded", &KDTree<double>::radius_neighbors_idx_multithreaded,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nThreads"), pybind11::arg("nnz_per_query") = 0)
+      .def("radius_neighbors_idx_dists_multithreaded", &KDTree<double>::radius_neighbors_idx_dists_multithreaded,
+           pybind11::arg("array"), pybind11::arg("radius"), pybind11::arg("nThreads"), pybind11::arg("nnz_per_query") = 0)
       .def("radius_neighbors_idx_dists_full", &KDTree<double>::radius_neighbors_idx_dists_full)
       .def("radius_neighbors_idx_dists_full_multithreaded", &KDTree<double>::radius_neighbors_idx_dists_full_multithreaded)
       .def("getResultLenghts", &KDTree<double>::getResultLenghts)
-      .def("getResultIndicesPtr", &KDTree<double>::getResultIndicesPtr)
-      .def("getResultIndicesRow", &KDTree<double>::getResultIndicesRow)
-      .def("getResultIndicesCol", &KDTree<double>::getResultIndicesCol)
-      .def("getResultDists", &KDTree<double>::getResultDists)
+      .def("getResultIndicesPtr", &KDTree<double>::getResultIndicesPtr, pybind11::arg("take") = false)
+      .def("getResultIndicesRow", &KDTree<double>::getResultIndicesRow, pybind11::arg("take") = false)
+      .def("getResultIndicesCol", &KDTree<double>::getResultIndicesCol, pybind11::arg("take") = false)
+      .def("getResultDists", &KDTree<double>::getResultDists, pybind11::arg("take") = false)
       .def("getResultRawDists", &KDTree<double>::getResultRawDists)
-      .def("save_index", &KDTree<double>::save_index);
+      .def("getResultArrays", &KDTree<double>::getResultArrays,
+           pybind11::arg("with_rows") = true, pybind11::arg("with_ptr") = true, pybind11::arg("take") = false)
+      .def("save_index", &KDTree<double>::save_index)
+      .def("get_handle", [](const KDTree<double> &t) { return reinterpret_cast<uintptr_t>(t.index); })
+      .def_readwrite("thread_affinity", &KDTree<double>::thread_affinity)
+      .def_readwrite("tile_size", &KDTree<double>::tile_size);
 
 }
@@ -101,3 +101,315 @@ def test_kdtree_l21_nd_f64():
             vts1 = np.random.rand(NB_MTX, m, n).astype(np.float64)
             vts2 = np.random.rand(NB_MTX, m, n).astype(np.float64)
             kdtree_test(vts1, vts2, p=2, q=1, tree_m="l21")
+
+
+def test_kdtree_l21_soa():
+    # fixed-size kernels up to 8 2D or 4 3D/4D points, SoA layout above
+    for n, max_m in [(2, 8), (3, 4), (4, 4)]:
+        for m, soa in [(max_m, False), (max_m + 1, True)]:
+            lpq_tree = lpqtree.KDTree(metric="l21", radius=0.5)
+            lpq_tree.fit(np.random.rand(NB_MTX, m, n))
+            assert (lpq_tree._fit_X_soa is not None) == soa, "test l21 SoA layout"
+
+
+def test_kdtree_non_contiguous():
+    vts = np.random.rand(3, NB_MTX, 4).astype(np.float32).transpose((1, 2, 0))
+    assert not vts.flags['C_CONTIGUOUS']
+
+    lpq_tree = lpqtree.KDTree(metric="l21", radius=MAXDIST)
+    with pytest.warns(UserWarning):
+        lpq_tree.fit(vts)
+    with pytest.warns(UserWarning):
+        lpq_tree.radius_neighbors(vts, MAXDIST, return_distance=True, no_return=True)
+
+    lpq_res = lpqdist.lpq_allpairs(vts, vts, p=2, q=1)
+    assert np.allclose(lpq_res, lpq_tree.get_coo_matrix().A), "test non-contiguous dist mtx"
+
+    # tree and search points are copied (and warned about) once each
+    with pytest.warns(UserWarning) as record:
+        lpq_tree.fit_and_radius_search(vts, vts, MAXDIST, nb_mpts=2)
+    assert len(record) == 2, "test non-contiguous single copy"
+    assert np.allclose(lpq_res, lpq_tree.get_coo_matrix().A), "test non-contiguous mpts dist mtx"
+
+
+def test_kdtree_n_jobs():
+    vts1 = np.random.rand(NB_MTX, 3).astype(np.float32)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float32)
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+
+    res = lpq_tree.radius_neighbors(vts1, n_jobs=1)
+    for n_jobs in [-1, 2, 4]:
+        res_mt = lpq_tree.radius_neighbors(vts1, n_jobs=n_jobs)
+        for r, r_mt in zip(res, res_mt):
+            assert np.array_equal(r, r_mt), "test n_jobs"
+
+    with pytest.raises(ValueError):
+        lpq_tree.radius_neighbors(vts1, n_jobs=0)
+    with pytest.raises(ValueError):
+        lpq_tree.fit_and_radius_search(vts2, vts1, 0.5, n_jobs=-2, nb_mpts=1)
+
+
+def test_kdtree_sparse_shape():
+    vts1 = np.random.rand(NB_MTX // 2, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float64)
+    lpq_res = lpqdist.l2(vts1[:, None] - vts2[None])
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=MAXDIST)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors(vts1, MAXDIST, no_return=True)
+    for mtx in [lpq_tree.get_csr_matrix(), lpq_tree.get_coo_matrix(), lpq_tree.get_csc_matrix()]:
+        assert mtx.shape == (NB_MTX // 2, NB_MTX), "test sparse mtx shape"
+        assert np.allclose(lpq_res, mtx.A), "test sparse mtx"
+
+
+def test_kdtree_results_read_only():
+    vts1 = np.random.rand(NB_MTX, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float64)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    dists = lpq_tree.get_dists()
+    dists_ref = dists.copy()
+    with pytest.raises(ValueError):
+        dists *= 2
+
+    csr = lpq_tree.get_csr_matrix()
+    csr.sort_indices()
+    csr.sum_duplicates()
+    csr *= 2
+    csr.data *= 0.5
+    csr.eliminate_zeros()
+    coo = lpq_tree.get_coo_matrix()
+    coo.data *= 2
+    assert np.array_equal(dists_ref, dists), "test shared dists unchanged"
+    assert np.array_equal(dists_ref, lpq_tree.get_dists()), "test cached dists unchanged"
+    assert np.allclose(csr.A, lpq_tree.get_csc_matrix().A), "test writable csr"
+    assert np.allclose(coo.A, 2 * csr.A), "test writable coo"
+
+
+def test_kdtree_l2sq():
+    vts1 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+    lpq_res = lpqdist.lpq_allpairs(vts1, vts2, p=2, q=2) ** 2
+
+    for r in [0.5, 1.0, MAXDIST]:
+        val_mask = lpq_res < r
+        lpq_tree = lpqtree.KDTree(metric="l2sq", radius=r)
+        lpq_tree.fit(vts2)
+        lpq_tree.radius_neighbors(vts1, r, no_return=True)
+        lpq_tree_mtx = lpq_tree.get_coo_matrix()
+        assert np.allclose(lpq_res[val_mask], lpq_tree_mtx.A[val_mask]), "test l2sq dist mtx"
+        assert lpq_tree_mtx.nnz == np.count_nonzero(val_mask), "test l2sq radius"
+
+
+def test_kdtree_float16():
+    vts1 = np.random.rand(NB_MTX, 2, 3).astype(np.float16)
+    vts2 = np.random.rand(NB_MTX, 2, 3).astype(np.float16)
+    lpq_res = lpqdist.lpq_allpairs(vts1.astype(np.float32), vts2.astype(np.float32), p=2, q=1)
+
+    lpq_tree = lpqtree.KDTree(metric="l21", radius=1.0)
+    lpq_tree.fit(vts2)
+    assert lpq_tree._fit_X_raw is vts2, "test fp16 raw data"
+    assert lpq_tree.get_data(copy=False).dtype == np.float32, "test fp16 tree data"
+
+    lpq_tree.radius_neighbors(vts1, 1.0, no_return=True)
+    lpq_tree_mtx = lpq_tree.get_coo_matrix()
+    val_mask = lpq_res < 1.0
+    assert np.allclose(lpq_res[val_mask], lpq_tree_mtx.A[val_mask], atol=1e-5), "test fp16 dist mtx"
+
+
+def test_kdtree_mmap(tmp_path):
+    vts1 = np.random.rand(NB_MTX, 3).astype(np.float32)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float32)
+    data_path = str(tmp_path / "vts2.npy")
+    np.save(data_path, vts2)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    lpq_tree_mtx = lpq_tree.get_coo_matrix()
+
+    mmap_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    mmap_tree.fit(mmap_path=data_path)
+    assert isinstance(mmap_tree.get_data(copy=False), np.memmap), "test mmap data"
+    mmap_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    assert np.allclose(lpq_tree_mtx.A, mmap_tree.get_coo_matrix().A), "test mmap dist mtx"
+
+    with pytest.raises(ValueError):
+        mmap_tree.fit(vts2, mmap_path=data_path)
+
+
+def test_kdtree_cfunc():
+    import ctypes
+    vts1 = np.random.rand(NB_MTX, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float64)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    lpq_tree_mtx = lpq_tree.get_csr_matrix()
+
+    proto = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double,
+                             ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int64)
+    search = proto(lpqtree.radius_neighbors_cfunc_addr(np.float64))
+    handle = lpq_tree.get_cfunc_handle()
+
+    max_k = NB_MTX
+    out_idx = np.empty(max_k, dtype=np.int64)
+    out_dist = np.empty(max_k, dtype=np.float64)
+    for i in range(0, NB_MTX, 7):
+        nb = search(handle, vts1[i].ctypes.data, 0.5, out_idx.ctypes.data, out_dist.ctypes.data, max_k)
+        row = lpq_tree_mtx.getrow(i)
+        assert nb == row.nnz, "test cfunc radius"
+        order = np.argsort(out_idx[:nb])
+        assert np.array_equal(out_idx[:nb][order], np.sort(row.indices)), "test cfunc indices"
+        assert np.allclose(out_dist[:nb][order], row.data[np.argsort(row.indices)]), "test cfunc dists"
+
+
+def test_kdtree_tiles():
+    vts1 = np.random.rand(NB_MTX, 3).astype(np.float32)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float32)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    lpq_tree_mtx = lpq_tree.get_csr_matrix()
+
+    for tile_size in [0, 1, 7, NB_MTX]:
+        lpq_tree.index.tile_size = tile_size
+        lpq_tree.index.radius_neighbors_idx_dists_multithreaded(vts1, 0.5, 3)
+        tiled_mtx = lpq_tree.get_csr_matrix()
+        assert np.allclose(lpq_tree_mtx.A, tiled_mtx.A), "test tiled multithreaded search"
+
+    # more threads than batches of queries
+    lpq_tree.radius_neighbors(vts1[:10], 0.5, no_return=True)
+    lpq_tree_mtx = lpq_tree.get_csr_matrix()
+    for tile_size in [0, 3]:
+        lpq_tree.index.tile_size = tile_size
+        lpq_tree.index.radius_neighbors_idx_multithreaded(vts1[:10], 0.5, 8, 1)
+        assert np.array_equal(lpq_tree_mtx.indices, lpq_tree.index.getResultIndicesCol()), "test idx nb threads"
+        lpq_tree.index.radius_neighbors_idx_dists_multithreaded(vts1[:10], 0.5, 8, 1)
+        assert np.allclose(lpq_tree_mtx.A, lpq_tree.get_csr_matrix().A), "test dists nb threads"
+        lpq_tree.index.radius_neighbors_idx_dists_full_multithreaded(vts1[:10], vts2, vts1[:10], 0.5, 0.5, 8)
+        assert np.allclose(lpq_tree_mtx.A, lpq_tree.get_csr_matrix().A), "test full nb threads"
+
+
+def test_kdtree_tiles_nb_threads():
+    # a batch smaller than one L2 tile is still split on all threads
+    vts = np.random.rand(8000, 3).astype(np.float32)
+    tile_size = lpqtree.lpqtree._get_tile_size(vts)
+    assert tile_size > vts.shape[0]
+    for n_jobs in [1, 2, 4, 8]:
+        assert lpqtree.lpqtree.nanoflann_ext.nb_batches(vts.shape[0], n_jobs, tile_size) == n_jobs, "test nb tiles"
+    assert lpqtree.lpqtree.nanoflann_ext.nb_batches(100, 4, 7) == 15, "test nb tiles (L2 tiles)"
+
+
+def test_kdtree_full_l2():
+    vts1 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+    lpq_res = lpqdist.lpq_allpairs(vts1, vts2, p=2, q=2)
+    val_mask = lpq_res < 0.5
+
+    # mean-points identical to the full points, the full distance is checked
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors_full(vts1, vts2, vts1, 0.5)
+    lpq_tree_mtx = lpq_tree.get_coo_matrix()
+    assert np.allclose(lpq_res[val_mask], lpq_tree_mtx.A[val_mask]), "test full l2 dist mtx"
+    assert lpq_tree_mtx.nnz == np.count_nonzero(val_mask), "test full l2 radius"
+
+
+def test_kdtree_full_l2_offset_f32():
+    # mm-scale coordinates, far from the origin
+    vts = (100.0 + 20.0 * np.random.randn(NB_MTX, 12, 3)).astype(np.float32)
+    vts[1::2] = vts[::2] + 0.1 * np.random.randn(NB_MTX // 2, 12, 3).astype(np.float32)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=2.0)
+    lpq_tree.fit(vts)
+    lpq_tree.radius_neighbors_full(vts, vts, vts, 2.0)
+    lpq_tree_mtx = lpq_tree.get_coo_matrix()
+    assert np.allclose(lpq_tree_mtx.diagonal(), 0.0, atol=1e-3), "test full l2 self dist"
+
+    lpq_res = lpqdist.lpq_allpairs(vts.astype(np.float64), vts.astype(np.float64), p=2, q=2)
+    val_mask = lpq_res < 2.0
+    assert lpq_tree_mtx.nnz == np.count_nonzero(val_mask), "test full l2 offset radius"
+    assert np.allclose(lpq_res[val_mask], lpq_tree_mtx.A[val_mask], atol=1e-4), "test full l2 offset dist mtx"
+
+
+def test_kdtree_full_shapes():
+    vts1 = np.random.rand(NB_MTX, 4, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+
+    lpq_tree = lpqtree.KDTree(metric="l21", radius=0.5)
+    with pytest.raises(ValueError):
+        lpq_tree.fit_and_radius_search(vts2, vts1, 0.5, nb_mpts=2)
+
+    lpq_tree.fit(vts2[:, :1])
+    with pytest.raises(ValueError):
+        lpq_tree.radius_neighbors_full(vts1[:, :1], vts2, vts1, 0.5)
+
+
+def test_kdtree_return_distance():
+    vts1 = np.random.rand(NB_MTX, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float64)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    rows, cols, dists = lpq_tree.radius_neighbors(vts1, 0.5, return_distance=True)
+    rows_idx, cols_idx = lpq_tree.radius_neighbors(vts1, 0.5, return_distance=False)
+    assert np.array_equal(rows, rows_idx), "test return_distance rows"
+    assert np.array_equal(cols, cols_idx), "test return_distance cols"
+    assert len(dists) == len(cols), "test return_distance dists"
+
+
+def test_kdtree_multithreaded_results():
+    vts1 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 2, 3).astype(np.float64)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    lpq_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    lpq_tree_mtx = lpq_tree.get_csr_matrix()
+    raw_dists = lpq_tree.index.getResultRawDists()
+
+    X = vts1.reshape((NB_MTX, -1))
+    lpq_tree.index.radius_neighbors_idx_dists_multithreaded(X, 0.5, 3)
+    assert np.array_equal(lpq_tree_mtx.indptr, lpq_tree.index.getResultIndicesPtr()), "test multithreaded ptr"
+    assert np.array_equal(lpq_tree_mtx.indices, lpq_tree.index.getResultIndicesCol()), "test multithreaded cols"
+    assert np.allclose(lpq_tree_mtx.data, lpq_tree.index.getResultDists()), "test multithreaded dists"
+    assert np.allclose(raw_dists, lpq_tree.index.getResultRawDists()), "test multithreaded raw dists"
+    for _ in range(2):
+        # taken by the matrix, the flat cols are still there for the next one
+        assert np.array_equal(lpq_tree_mtx.indices, lpq_tree.get_csr_matrix().indices), "test multithreaded csr"
+
+    lpq_tree.index.radius_neighbors_idx_multithreaded(X, 0.5, 3)
+    assert np.array_equal(lpq_tree_mtx.indices, lpq_tree.index.getResultIndicesCol()), "test multithreaded idx"
+    with pytest.raises(RuntimeError):
+        lpq_tree.get_dists()
+    with pytest.raises(RuntimeError):
+        lpq_tree.get_csr_matrix()
+    with pytest.raises(RuntimeError):
+        lpq_tree.index.getResultRawDists()
+
+    Y = vts2.reshape((NB_MTX, -1))
+    lpq_tree.index.radius_neighbors_idx_dists_full_multithreaded(X, Y, X, 0.5, 0.5, 3)
+    assert np.array_equal(lpq_tree_mtx.indices, lpq_tree.index.getResultIndicesCol()), "test multithreaded full cols"
+    assert np.allclose(lpq_tree_mtx.data, lpq_tree.index.getResultDists()), "test multithreaded full dists"
+
+
+def test_kdtree_nnz_estimate():
+    vts1 = np.random.rand(2 * lpqtree.lpqtree.MIN_NNZ_ESTIMATE_QUERIES, 3).astype(np.float64)
+    vts2 = np.random.rand(NB_MTX, 3).astype(np.float64)
+
+    lpq_tree = lpqtree.KDTree(metric="l2", radius=0.5)
+    lpq_tree.fit(vts2)
+    nnz = lpq_tree._estimate_nnz_per_query(vts1, 0.5)
+    lpq_tree.radius_neighbors(vts1, 0.5, no_return=True)
+    mean_nnz = lpq_tree.get_dists().size / vts1.shape[0]
+    assert 0.5 * mean_nnz < nnz < 2.5 * mean_nnz, "test nnz estimate"
+
+    lpq_tree_mtx = lpq_tree.get_csr_matrix()
+    lpq_tree.index.radius_neighbors_idx_dists_multithreaded(vts1, 0.5, 3, nnz)
+    assert np.array_equal(lpq_tree_mtx.indices, lpq_tree.index.getResultIndicesCol()), "test nnz estimate search"